@@ -0,0 +1,397 @@
+#! /bin/env python3
+"""
+Benchmark for the swanctl autocompletion.
+Starts a fake charon on a UNIX socket that answers list-conns, get-conns,
+list-sas, get-pools, get-authorities, list-certs and stats with generated
+connections, IKE_SAs, CHILD_SAs, pools, authorities and certificates and
+runs representative completions against it, either through the _swanctl bash
+function built from part1/part2 or directly through SwanctlAutoComplete.main.
+Reports p50/p99 latency, the share of the interpreter startup and the peak RSS
+for every scenario.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from swanctl import ViciSession, vici_decode, vici_encode
+
+
+# (name, words, cur, prev, cword) as passed by _init_completion
+SCENARIOS = [
+    ("commands", ["swanctl", ""], "", "swanctl", 1),
+    ("options", ["swanctl", "--terminate", ""], "", "--terminate", 2),
+    ("ike-config", ["swanctl", "--initiate", "--ike", ""], "", "--ike", 3),
+    ("child-config", ["swanctl", "--initiate", "--child", ""], "", "--child", 3),
+    ("ike-name", ["swanctl", "--terminate", "--ike", ""], "", "--ike", 3),
+    ("ike-name-prefix", ["swanctl", "--terminate", "--ike", "conn1"], "conn1", "--ike", 3),
+    ("ike-id", ["swanctl", "--terminate", "--ike-id", ""], "", "--ike-id", 3),
+    ("child-name", ["swanctl", "--terminate", "--child", ""], "", "--child", 3),
+    ("child-id", ["swanctl", "--terminate", "--ike", "conn1", "--child-id", ""], "",
+     "--child-id", 5),
+    ("pools", ["swanctl", "--list-pools", "--name", ""], "", "--name", 3),
+    ("authorities", ["swanctl", "--list-authorities", "--name", ""], "", "--name", 3),
+    ("peer-id", ["swanctl", "--redirect", "--peer-id", ""], "", "--peer-id", 3),
+    ("cert-subject", ["swanctl", "--list-certs", "--subject", ""], "", "--subject", 3),
+]
+
+
+def der(tag, content):
+    """
+    Encode a DER element
+    """
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(length)]) + length + content
+
+
+def der_name(rdns):
+    """
+    Encode a DN given as (encoded OID, value) tuples
+    """
+    return der(0x30, b"".join(der(0x31, der(0x30, der(0x06, oid) + der(0x0c, value.encode())))
+                              for oid, value in rdns))
+
+
+def fake_certificate(serial, subject, issuer):
+    """
+    Return a DER encoded X.509 certificate with the given subject and issuer
+    CN and random bytes as key and signature
+    """
+    base = [(b"\x55\x04\x06", "CH"), (b"\x55\x04\x0a", "strongSwan"),
+            (b"\x55\x04\x0b", "bench")]
+    algorithm = der(0x30, der(0x06, b"\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b") + b"\x05\x00")
+    tbs = der(0x30, der(0xa0, der(0x02, b"\x02")) + der(0x02, serial.to_bytes(4, "big")) +
+              algorithm + der_name(base + [(b"\x55\x04\x03", issuer)]) +
+              der(0x30, der(0x17, b"260101000000Z") + der(0x17, b"360101000000Z")) +
+              der_name(base + [(b"\x55\x04\x03", subject)]) +
+              der(0x30, algorithm + der(0x03, b"\x00" + os.urandom(270))))
+    return der(0x30, tbs + algorithm + der(0x03, b"\x00" + os.urandom(256)))
+
+
+class FakeCharon():
+    """
+    Minimal VICI server with generated data. IKE_SAs are spread evenly over
+    the connections and named after them, like road warrior connections.
+    All messages are encoded once up front, so the server itself does not
+    dominate the measurements with many SAs.
+    """
+    def __init__(self, path, conns, ike_sas, child_sas, pools, certs):
+        self.path = path
+        self.conn_events = {}
+        for conn in range(conns):
+            name = "conn%d" % conn
+            children = {"%s-c%d" % (name, child): {"mode": "TUNNEL"}
+                        for child in range(child_sas)}
+            self.conn_events[name] = vici_encode({name: {"children": children}})
+        self.get_conns = vici_encode({"conns": list(self.conn_events)})
+        # IKE_SA name -> [(unique id, encoded list-sa event)]
+        self.sa_events = {}
+        child_id = ike_sas
+        for ike_id in range(1, ike_sas + 1):
+            name = "conn%d" % (ike_id % conns)
+            child_sas_of_ike = {}
+            for child in range(child_sas):
+                child_id += 1
+                child_sas_of_ike["%s-c%d-%d" % (name, child, child_id)] = {
+                    "name": "%s-c%d" % (name, child), "uniqueid": str(child_id),
+                    "state": "INSTALLED", "protocol": "ESP"}
+            event = vici_encode({name: {"uniqueid": str(ike_id), "version": "2",
+                                        "state": "ESTABLISHED",
+                                        "remote-id": "peer%d@example.org" % ike_id,
+                                        "child-sas": child_sas_of_ike}})
+            self.sa_events.setdefault(name, []).append((str(ike_id), event))
+        self.get_pools = vici_encode({"pool%d" % pool: {"base": "10.%d.0.0" % pool}
+                                      for pool in range(pools)})
+        self.get_authorities = vici_encode({"authorities": ["ca%d" % authority
+                                                            for authority in range(pools)]})
+        # (type, flag, encoded list-cert event), one CA and end entities
+        self.cert_events = [("X509", "CA", vici_encode(
+            {"type": "X509", "flag": "CA", "has_privkey": "no",
+             "data": fake_certificate(0, "BenchCA", "BenchCA")}))]
+        for cert in range(1, certs):
+            self.cert_events.append(("X509", "NONE", vici_encode(
+                {"type": "X509", "flag": "NONE", "has_privkey": "no",
+                 "data": fake_certificate(cert, "host%d.example.org" % cert, "BenchCA")})))
+        self.stats = vici_encode({"uptime": {"running": "0 seconds",
+                                             "since": time.strftime("%b %d %H:%M:%S %Y")}})
+        self.server = None
+
+    def start(self):
+        """
+        Listen on the socket and answer sessions in threads
+        """
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(128)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        """
+        Accept sessions until the socket is closed
+        """
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        """
+        Answer the requests of one session until the client disconnects
+        """
+        session = ViciSession(connection)
+        try:
+            while True:
+                packet_type, name, message = session.receive()
+                if packet_type in (session.EVENT_REGISTER, session.EVENT_UNREGISTER):
+                    session.send(session.EVENT_CONFIRM)
+                elif packet_type == session.CMD_REQUEST:
+                    self.command(session, name, vici_decode(message) if message else {})
+        except (OSError, EOFError, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def command(self, session, name, filters):
+        """
+        Answer one command request
+        """
+        ike = filters.get("ike", b"").decode("utf-8")
+        ike_id = filters.get("ike-id", b"").decode("utf-8")
+        if name == "list-sas":
+            for sa_name, events in self.sa_events.items():
+                if ike and sa_name != ike:
+                    continue
+                for unique_id, event in events:
+                    if not ike_id or unique_id == ike_id:
+                        session.send(session.EVENT, "list-sa", event)
+            session.send(session.CMD_RESPONSE)
+        elif name == "list-conns":
+            for conn_name, event in self.conn_events.items():
+                if not ike or conn_name == ike:
+                    session.send(session.EVENT, "list-conn", event)
+            session.send(session.CMD_RESPONSE)
+        elif name == "get-conns":
+            session.send(session.CMD_RESPONSE, None, self.get_conns)
+        elif name == "get-pools":
+            session.send(session.CMD_RESPONSE, None, self.get_pools)
+        elif name == "get-authorities":
+            session.send(session.CMD_RESPONSE, None, self.get_authorities)
+        elif name == "list-certs":
+            cert_type = filters.get("type", b"ANY").decode("utf-8")
+            flag = filters.get("flag", b"ANY").decode("utf-8")
+            for event_type, event_flag, event in self.cert_events:
+                if cert_type in ("ANY", event_type) and flag in ("ANY", event_flag):
+                    session.send(session.EVENT, "list-cert", event)
+            session.send(session.CMD_RESPONSE)
+        elif name == "stats":
+            session.send(session.CMD_RESPONSE, None, self.stats)
+        else:
+            session.send(session.CMD_UNKNOWN)
+
+    def stop(self):
+        """
+        Stop accepting sessions and remove the socket
+        """
+        self.server.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def build_bash_script(source_dir, path):
+    """
+    Build the completion script like makeme.sh does, so the working tree is
+    measured and not the last generated swanctl.sh
+    """
+    with open(path, "w") as script:
+        for part in ("part1", "swanctl.py", "part2"):
+            with open(os.path.join(source_dir, part)) as part_file:
+                script.write(part_file.read())
+
+
+def bash_command(script, words, cur, prev, cword):
+    """
+    Return a command that sources the completion script with a stubbed
+    _init_completion, runs _swanctl and prints its duration in microseconds
+    followed by COMPREPLY. _filedir and _known_hosts_real are stubbed as well.
+    """
+    quoted_words = " ".join(quote(word) for word in words)
+    return "\n".join([
+        "_init_completion() { words=(%s); cur=%s; prev=%s; cword=%d; }"
+        % (quoted_words, quote(cur), quote(prev), cword),
+        "_filedir() { COMPREPLY=(); }",
+        "_known_hosts_real() { COMPREPLY=(); }",
+        "source %s" % quote(script),
+        "start=${EPOCHREALTIME/./}",
+        "_swanctl",
+        "end=${EPOCHREALTIME/./}",
+        "echo $((end - start))",
+        "printf \"%s\\n\" \"${COMPREPLY[@]}\"",
+    ])
+
+
+def quote(word):
+    """
+    Quote a word for bash
+    """
+    import shlex
+    return shlex.quote(word)
+
+
+def run(argv, env):
+    """
+    Run a command, returning its output, wall time in seconds and peak RSS in KiB
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.stdout.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return output.decode("utf-8"), elapsed, usage.ru_maxrss
+
+
+def percentile(samples, fraction):
+    """
+    Nearest rank percentile of the samples
+    """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(args, env, script, scenario):
+    """
+    Run one scenario args.runs times, returns the result dict
+    """
+    name, words, cur, prev, cword = scenario
+    if args.driver == "bash":
+        argv = ["bash", "--norc", "--noprofile", "-c",
+                bash_command(script, words, cur, prev, cword)]
+    else:
+        argv = [sys.executable, script, "--words=%s" % " ".join(words),
+                "--cur=%s" % cur, "--prev=%s" % prev, "--cword=%d" % cword]
+    latencies = []
+    peak_rss = 0
+    candidates = 0
+    for run_number in range(args.warmup + args.runs):
+        output, elapsed, rss = run(argv, env)
+        if args.driver == "bash":
+            duration, _, output = output.partition("\n")
+            elapsed = int(duration) / 1e6
+            candidates = len([line for line in output.splitlines() if line])
+        else:
+            candidates = len(output.split())
+        if run_number >= args.warmup:
+            latencies.append(elapsed)
+            peak_rss = max(peak_rss, rss)
+    return {"scenario": name, "driver": args.driver, "candidates": candidates,
+            "p50_ms": percentile(latencies, 0.5) * 1e3,
+            "p99_ms": percentile(latencies, 0.99) * 1e3,
+            "peak_rss_kib": peak_rss}
+
+
+def main():
+    """
+    Parse the arguments, start the fake charon and run the scenarios
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--driver", choices=("bash", "main"), default="bash",
+                        help="complete through _swanctl (default) or swanctl.py directly")
+    parser.add_argument("--script",
+                        help="completion script to run with the bash driver, e.g. one "
+                             "built by makeme.sh install (default: part1/part2)")
+    parser.add_argument("--conns", type=int, default=50)
+    parser.add_argument("--ike-sas", type=int, default=1000)
+    parser.add_argument("--child-sas", type=int, default=2,
+                        help="CHILD_SAs per IKE_SA and children per connection")
+    parser.add_argument("--pools", type=int, default=10,
+                        help="pools and authorities")
+    parser.add_argument("--certs", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--cache", choices=("cold", "warm"), default="cold",
+                        help="disable the result cache (default) or use it")
+    parser.add_argument("--timeout", default="0",
+                        help="SWANCTL_COMPLETION_TIMEOUT in ms, 0 (default) measures "
+                             "complete answers")
+    parser.add_argument("--scenario", action="append",
+                        help="only run the given scenario, can be repeated")
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="swanctl-bench-")
+    try:
+        vici_path = os.path.join(work_dir, "charon.vici")
+        charon = FakeCharon(vici_path, args.conns, args.ike_sas, args.child_sas, args.pools,
+                            args.certs)
+        charon.start()
+
+        env = dict(os.environ)
+        env.update({"SWANCTL_COMPLETION_VICI_URI": "unix://" + vici_path,
+                    "SWANCTL_COMPLETION_CACHE_DIR": os.path.join(work_dir, "cache"),
+                    "SWANCTL_COMPLETION_SOCKET": os.path.join(work_dir, "none.sock"),
+                    "SWANCTL_COMPLETION_TIMEOUT": args.timeout})
+        if args.cache == "cold":
+            env["SWANCTL_COMPLETION_CACHE_TTL"] = "conns=0,sas=0,pools=0,authorities=0,certs=0"
+        if args.driver == "bash":
+            script = args.script
+            if not script:
+                script = os.path.join(work_dir, "swanctl.sh")
+                build_bash_script(source_dir, script)
+            # the completion script runs "python", make it this interpreter
+            bin_dir = os.path.join(work_dir, "bin")
+            os.mkdir(bin_dir)
+            os.symlink(sys.executable, os.path.join(bin_dir, "python"))
+            env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+        else:
+            script = os.path.join(source_dir, "swanctl.py")
+
+        startup = [run([sys.executable, "-c", "pass"], env)[1] for _ in range(args.runs)]
+        startup_ms = percentile(startup, 0.5) * 1e3
+
+        if not args.json:
+            print("%d connections, %d IKE_SAs, %d CHILD_SAs, %s cache, driver %s, "
+                  "interpreter startup %.1f ms"
+                  % (args.conns, args.ike_sas, args.ike_sas * args.child_sas,
+                     args.cache, args.driver, startup_ms))
+            print("%-16s %10s %9s %9s %8s %9s"
+                  % ("scenario", "candidates", "p50 ms", "p99 ms", "startup", "RSS MiB"))
+        for scenario in SCENARIOS:
+            if args.scenario and scenario[0] not in args.scenario:
+                continue
+            result = measure(args, env, script, scenario)
+            result["startup_share"] = min(1.0, startup_ms / result["p50_ms"])
+            if args.json:
+                print(json.dumps(result, sort_keys=True))
+            else:
+                print("%-16s %10d %9.1f %9.1f %7.0f%% %9.1f"
+                      % (result["scenario"], result["candidates"], result["p50_ms"],
+                         result["p99_ms"], result["startup_share"] * 100,
+                         result["peak_rss_kib"] / 1024))
+            sys.stdout.flush()
+        charon.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#! /bin/env python3
+"""
+Import check for the static completions of swanctl.py.
+Runs the completions that need no data from charon (commands, option lists
+and fixed values) with -X importtime and fails if they import a module that
+the bare interpreter startup does not import. Modules built into the
+interpreter (like time) are allowed, but their import time counts towards a
+fixed budget.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# (name, words, cur, prev, cword) as passed by _init_completion
+SCENARIOS = [
+    ("commands", ["swanctl", ""], "", "swanctl", 1),
+    ("command-prefix", ["swanctl", "--te"], "--te", "swanctl", 1),
+    ("options", ["swanctl", "--terminate", ""], "", "--terminate", 2),
+    ("option-prefix", ["swanctl", "--list-certs", "--t"], "--t", "--list-certs", 2),
+    ("debug-levels", ["swanctl", "--initiate", "--debug", ""], "", "--debug", 3),
+    ("cert-types", ["swanctl", "--list-certs", "--type", ""], "", "--type", 3),
+]
+
+
+def imports(argv, env):
+    """
+    Run argv with -X importtime, returns a dict of the imported modules and
+    their own import time in microseconds
+    """
+    # the exit status of a completion tells the completion script what to
+    # do with the candidates, it is not checked here
+    process = subprocess.run([sys.executable, "-X", "importtime"] + argv, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    modules = {}
+    for line in process.stderr.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.partition("import time:")[2].split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            modules[fields[2].strip()] = int(fields[0])
+    return modules
+
+
+def main():
+    """
+    Parse the arguments and check every scenario, exits with 1 if one of
+    them imports too much
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--script", default=os.path.join(source_dir, "swanctl.py"))
+    parser.add_argument("--budget", type=float, default=2.0,
+                        help="maximum time in ms a completion may spend importing "
+                             "modules besides those of the interpreter startup")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="swanctl-importcheck-")
+    try:
+        env = dict(os.environ)
+        for name in ("SWANCTL_COMPLETION_TRACE", "SWANCTL_COMPLETION_PREFETCH"):
+            env.pop(name, None)
+        # charon is not needed, make sure it is not reached either
+        env.update({"SWANCTL_COMPLETION_VICI_URI":
+                        "unix://" + os.path.join(work_dir, "charon.vici"),
+                    "SWANCTL_COMPLETION_CACHE_DIR": os.path.join(work_dir, "cache"),
+                    "SWANCTL_COMPLETION_CONF": os.path.join(work_dir, "swanctl.conf")})
+        startup = imports(["-c", "pass"], env)
+
+        failed = False
+        print("%-16s %9s  %s" % ("scenario", "import ms", "modules beyond startup"))
+        for name, words, cur, prev, cword in SCENARIOS:
+            modules = imports([args.script, "--words=%s" % " ".join(words), "--cur=%s" % cur,
+                               "--prev=%s" % prev, "--cword=%d" % cword, "--protocol=1"], env)
+            extra = {module: micros for module, micros in modules.items()
+                     if module not in startup}
+            import_ms = sum(extra.values()) / 1000
+            foreign = sorted(module for module in extra
+                             if module not in sys.builtin_module_names)
+            if foreign or import_ms > args.budget:
+                failed = True
+            print("%-16s %9.2f  %s%s"
+                  % (name, import_ms, " ".join(sorted(extra)) or "-",
+                     "  FAIL" if foreign or import_ms > args.budget else ""))
+        sys.exit(1 if failed else 0)
+    finally:
+        # the options scenario starts a prefetch in the background, which
+        # has to give up on charon before its cache directory is removed
+        lock_path = os.path.join(work_dir, "cache", "prefetch.refresh")
+        for _ in range(100):
+            if not os.path.exists(lock_path):
+                break
+            time.sleep(0.01)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
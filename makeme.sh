@@ -1,3 +1,34 @@
 #! /bin/bash
 
-cat part1 swanctl.py part2 > swanctl.sh
\ No newline at end of file
+# Usage: makeme.sh [install DIR]
+# Builds swanctl.sh with swanctl.py embedded. With "install DIR", swanctl.py is
+# additionally installed as the module swanctl_completion into DIR together with
+# its compiled bytecode, and swanctl.sh runs that instead of the embedded copy
+# as long as the module exists.
+
+set -e
+
+module_dir=
+if [[ $1 == install ]]; then
+    if [[ -z $2 ]]; then
+        echo "Usage: $0 [install DIR]" >&2
+        exit 1
+    fi
+    mkdir -p "$2"
+    module_dir=$(cd "$2" && pwd)
+    cp swanctl.py "$module_dir/swanctl_completion.py"
+    # compile with the interpreter the completion script runs
+    python3 -m py_compile "$module_dir/swanctl_completion.py"
+fi
+
+if [[ -z $module_dir ]]; then
+    cat part1 swanctl.py part2 > swanctl.sh
+    exit 0
+fi
+# do not treat & in the directory as the matched text
+shopt -u patsub_replacement 2>/dev/null || true
+part1=$(<part1)
+{
+    printf '%s' "${part1/_swanctl_module_dir=/_swanctl_module_dir=$(printf '%q' "$module_dir")}"
+    cat swanctl.py part2
+} > swanctl.sh
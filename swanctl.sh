@@ -1,27 +1,92 @@
 # swanctl completion
 
-_swanctl() {
-    local cur prev words cword
-    _init_completion || return
+# Directory of the precompiled swanctl_completion module, set by
+# "makeme.sh install". The embedded script below is used if it is empty or the
+# module is missing.
+_swanctl_module_dir=
+
+# Ask the optional completion server (swanctl.py --server) for suggestions.
+# Prints its answer, see _swanctl_run. Fails if no server is listening, it
+# did not answer or socat is not available. Sockets of other users, or in
+# a directory of another user, are not trusted.
+_swanctl_server() {
+    local sock=${SWANCTL_COMPLETION_SOCKET} header
+    if [[ -z $sock ]]; then
+        if [[ -n $XDG_RUNTIME_DIR ]]; then
+            sock=$XDG_RUNTIME_DIR/swanctl-completion.sock
+        else
+            sock=/tmp/swanctl-completion-$UID/server.sock
+        fi
+    fi
+    [[ -S $sock && -O $sock && -O ${sock%/*} ]] && type -P socat &>/dev/null || return 1
+    printf '%s\n' "$@" | socat -t 1 - UNIX-CONNECT:"$sock" 2>/dev/null | {
+        IFS= read -r header && printf '%s\n' "$header" && cat
+    }
+}
+
+# Candidates of the last completion, which are reused while only the current
+# word grows (see the reusable flag below)
+_swanctl_memo_key=
+_swanctl_memo_cur=
+_swanctl_memo_time=
+_swanctl_memo_reply=()
+_swanctl_memo_quote=
+
+# Readline only replaces the part of the current word after the last = or :
+# in COMP_WORDBREAKS, strip what is in front of it from the candidates, like
+# __ltrim_colon_completions does for colons only
+_swanctl_ltrim_wordbreaks() {
+    local breaks=${COMP_WORDBREAKS//[^=:]/}
+    [[ -n $breaks && $cur == *[$breaks]* ]] || return
+    local prefix=${cur%"${cur##*[$breaks]}"}
+    COMPREPLY=("${COMPREPLY[@]#"$prefix"}")
+}
 
-    REPLY=$(python -c '#! /bin/env python3
+# Run swanctl.py with the given arguments. With --protocol=1 it prints a
+# header line "swanctl-completion 1 ACTION FLAGS" followed by the candidates,
+# each terminated by a NUL character.
+_swanctl_run() {
+    if [[ -n $_swanctl_module_dir && -r $_swanctl_module_dir/swanctl_completion.py ]]; then
+        # -I -S skip site and the environment, the module is loaded from
+        # its cached bytecode
+        python3 -I -S -c "import sys; sys.path.insert(0, sys.argv.pop(1)); import swanctl_completion; swanctl_completion.SwanctlAutoComplete.main()" "$_swanctl_module_dir" "$@"
+    else
+        python -c '#! /bin/env python3
 """
 Helper python script for the swanctl autocompletion bash script.
 Provides the ability to list IKE_SA and CHILD_SA names and IDs.
 """
-import argparse
-import itertools
-import os
-import shlex
-import socket
+# Only sys is imported here. Everything else is imported where it is needed,
+# so that completions that need no data from charon (commands, options,
+# debug levels, ...) do not pay for importing the socket stack.
 import sys
-import urllib
 
-try:
-    import vici
-    HAVE_VICI_EGG = True
-except:
-    HAVE_VICI_EGG = False
+
+class Arguments():
+    """
+    Arguments passed to the script by the completion script
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Result():
+    """
+    Result of one completion: the candidates to offer and the action of the
+    completion script, "none", "filedir" (complete file names) or "hosts"
+    (complete host names). filtered is set if the candidates only contain
+    those starting with the current word, reusable if they are complete for
+    every word starting with it, truncated if there are more than the
+    candidates.
+    """
+    def __init__(self, candidates=(), action="none", filtered=False, reusable=False,
+                 truncated=False):
+        self.candidates = list(candidates)
+        self.action = action
+        self.filtered = filtered
+        self.reusable = reusable
+        self.truncated = truncated
+
 
 def eprint(*args, **kwargs):
     """
@@ -30,6 +95,15 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def to_str(value):
+    """
+    Decode VICI values, which are bytes
+    """
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
 class SwanctlAutoComplete():
     """
     Implements the code for swanctl autocompletion
@@ -44,9 +118,201 @@ class SwanctlAutoComplete():
                      "--reload-settings", "--help"]
     short_commands = ["-C", "-i", "-t", "-R", "-d", "-u", "-p", "-l", "-m",
                       "-P", "-B", "-L", "-x", "-A", "-g", "-f", "-q", "-b",
-                      "-c", "-s", "-a", "-T", "-v", "-s", "-r", "-h"]
-    options = ["--help", "-h", "--raw", "-r", "--pretty", "-P", "--debug",
-               "-v", "--options", "-+", "--uri", "-u"]
+                      "-c", "-s", "-a", "-T", "-v", "-S", "-r", "-h"]
+    # Options accepted by every command, in the same format as the grammar
+    general_grammar = {
+        "options": [("-h", "--help"), ("-r", "--raw"), ("-P", "--pretty"),
+                    ("-v", "--debug"), ("-+", "--options"), ("-u", "--uri")],
+        "conflicts": [("--raw", "--pretty")],
+        "values": {"--debug": ("-1", "0", "1", "2", "3", "4"),
+                   "--options": "file", "--uri": "url"},
+    }
+    # Grammar of the swanctl commands. For every command: its short and long
+    # name, its options as (short, long) tuples, groups of options that
+    # exclude each other (by long name) and how to complete the value of an
+    # option: the name of a handler, a tuple of fixed values or None for
+    # options that take a value which can not be completed.
+    # Compiled into lookup tables by compile_grammar.
+    grammar = [
+        {"command": ("-C", "--counters"),
+         "options": [("-n", "--name"), ("-a", "--all"), ("-R", "--reset")],
+         "conflicts": [("--name", "--all")],
+         "values": {"--name": "ike_sa_name"}},
+        {"command": ("-i", "--initiate"),
+         "options": [("-c", "--child"), ("-i", "--ike")],
+         "values": {"--child": "child_sa_config", "--ike": "ike_sa_config"}},
+        {"command": ("-t", "--terminate"),
+         "options": [("-c", "--child"), ("-i", "--ike"), ("-C", "--child-id"),
+                     ("-I", "--ike-id"), ("-f", "--force"), ("-t", "--timeout")],
+         "conflicts": [("--child-id", "--ike-id", "--child", "--ike")],
+         "values": {"--child": "child_sa_name", "--ike": "ike_sa_name",
+                    "--child-id": "child_id", "--ike-id": "ike_id",
+                    "--timeout": None}},
+        {"command": ("-R", "--rekey"),
+         "options": [("-c", "--child"), ("-i", "--ike"), ("-C", "--child-id"),
+                     ("-I", "--ike-id"), ("-a", "--reauth")],
+         "conflicts": [("--child-id", "--ike-id")],
+         "values": {"--child": "child_sa_name", "--ike": "ike_sa_name",
+                    "--child-id": "child_id", "--ike-id": "ike_id"}},
+        {"command": ("-d", "--redirect"),
+         "options": [("-i", "--ike"), ("-I", "--ike-id"), ("-p", "--peer-id"),
+                     ("-g", "--gateway")],
+         "values": {"--ike": "ike_sa_name", "--ike-id": "ike_id",
+                    "--peer-id": "peer_id", "--gateway": "url"}},
+        {"command": ("-u", "--uninstall"),
+         "options": [("-i", "--ike"), ("-c", "--child")],
+         "values": {"--ike": "ike_sa_name", "--child": "child_sa_name"}},
+        {"command": ("-p", "--install"),
+         "options": [("-i", "--ike"), ("-c", "--child")],
+         "values": {"--ike": "ike_sa_name", "--child": "child_sa_name"}},
+        {"command": ("-l", "--list-sas"),
+         "options": [("-i", "--ike"), ("-I", "--ike-id")],
+         "values": {"--ike": "ike_sa_name", "--ike-id": "ike_id"}},
+        {"command": ("-m", "--monitor-sa")},
+        {"command": ("-P", "--list-pols"),
+         "options": [("-c", "--child"), ("-t", "--trap"), ("-d", "--drop"),
+                     ("-p", "--pass")],
+         "values": {"--child": "child_sa_name"}},
+        {"command": ("-B", "--list-authorities"),
+         "options": [("-n", "--name")],
+         "values": {"--name": "authority"}},
+        {"command": ("-L", "--list-conns"),
+         "options": [("-i", "--ike")],
+         "values": {"--ike": "ike_sa_config"}},
+        {"command": ("-x", "--list-certs"),
+         "options": [("-s", "--subject"), ("-t", "--type"), ("-f", "--flag"),
+                     ("-p", "--pem"), ("-S", "--short"), ("-U", "--utc")],
+         "values": {"--subject": "cert_subject",
+                    "--type": ("x509", "x509_ac", "x509_crl", "ocsp_response", "pubkey"),
+                    "--flag": ("none", "ca", "aa", "ocsp", "any")}},
+        {"command": ("-A", "--list-pools"),
+         "options": [("-l", "--leases"), ("-n", "--name"), ("-f", "--file")],
+         "values": {"--name": "pool", "--file": "file"}},
+        {"command": ("-g", "--list-algs")},
+        {"command": ("-f", "--flush-certs"),
+         "options": [("-t", "--type")],
+         "values": {"--type": ("x509", "x509_ac", "x509_crl", "ocsp_response", "pubkey")}},
+        {"command": ("-q", "--load-all"),
+         "options": [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")],
+         "values": {"--file": "file"}},
+        {"command": ("-b", "--load-authorities"),
+         "options": [("-f", "--file")],
+         "values": {"--file": "file"}},
+        {"command": ("-c", "--load-conns"),
+         "options": [("-f", "--file")],
+         "values": {"--file": "file"}},
+        {"command": ("-s", "--load-creds"),
+         "options": [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")],
+         "values": {"--file": "file"}},
+        {"command": ("-a", "--load-pools"),
+         "options": [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")],
+         "values": {"--file": "file"}},
+        {"command": ("-T", "--log")},
+        {"command": ("-v", "--version"),
+         "options": [("-d", "--daemon")]},
+        {"command": ("-S", "--stats")},
+        {"command": ("-r", "--reload-settings")},
+    ]
+    # names that are looked up the same way for every command that takes them,
+    # by kind of cached data: the swanctl.conf sections with the names, the
+    # VICI command that returns all of them and their path in its response.
+    # get-conns only returns the names, unlike list-conns.
+    lookups = {
+        "conns": (("connections", "*"), "get-conns", ("conns",)),
+        "pools": (("pools", "*"), "get-pools", ("*",)),
+        "authorities": (("authorities", "*"), "get-authorities", ("authorities",)),
+    }
+    # directories below SWANCTL_DIR swanctl --load-creds loads certificates from
+    cred_dirs = ("x509", "x509ca", "x509aa", "x509ocsp", "x509crl", "x509ac", "pubkey")
+    # grammar compiled by compile_grammar, by command name
+    compiled_grammar = None
+    # VICI sessions by thread ID, kept open for the lifetime of the process
+    sessions = {}
+    # default TTLs in seconds of cached VICI query results per kind of data
+    cache_ttls = {"conns": 30, "sas": 2, "pools": 30, "authorities": 30, "certs": 3600}
+    # seconds after which a background refresh is considered dead
+    refresh_lock_timeout = 30
+    # seconds after which an unused cache file of a query is removed
+    cache_max_age = 86400
+    # seconds between scans of the cache directory for such files
+    cache_cleanup_interval = 3600
+    # SA index maintained from VICI events by a watcher in this process
+    sa_index = None
+    # seconds between writes of the SA index state file
+    index_flush_interval = 0.5
+    # seconds to wait before reconnecting to charon after an error
+    watch_retry_interval = 2
+    # URI of the VICI socket if SWANCTL_COMPLETION_VICI_URI is not set
+    default_vici_uri = "unix:///var/run/charon.vici"
+    # URIs given with --uri on the command line being completed
+    uris = None
+    # refreshes requested by gather workers, by thread ident, which gather
+    # starts once they are done
+    deferred_refreshes = {}
+    # URI of the endpoint queried by a thread, by thread ident
+    thread_uris = {}
+    # URI of the VICI socket the SA index in sa_index is maintained for
+    watched_uri = None
+    # swanctl.conf if neither SWANCTL_COMPLETION_CONF nor SWANCTL_DIR are set
+    default_conf = "/etc/swanctl/swanctl.conf"
+    # maximum nesting of include statements in swanctl.conf
+    conf_include_depth = 10
+    # default time budget of one completion in milliseconds
+    default_timeout = 150
+    # monotonic time at which the current completion has to be answered
+    deadline = None
+    # seconds a background refresh of the cache may take
+    refresh_timeout = 10
+    # seconds between checks whether a concurrent identical query is done
+    flight_poll_interval = 0.01
+    # VICI queries per second of all completions sharing the rate limit file
+    # if SWANCTL_COMPLETION_RATE_LIMIT is not set
+    default_rate_limit = 20
+    # value handlers run in the background when the options of a command are
+    # completed, as the value of one of them is likely completed next
+    prefetch_handlers = ("ike_sa_config", "ike_sa_name", "child_sa_config",
+                         "child_sa_name", "ike_id", "child_id", "peer_id",
+                         "cert_subject")
+    # SA data of value handlers: the options whose values filter the
+    # list-sas and the data extracted from each IKE_SA, which together form
+    # the cache query, so a prefetch can fill the cache of all of them from
+    # a single list-sas
+    sa_queries = {
+        "ike_sa_name": (("--ike-id",), ()),
+        "child_sa_name": (("--ike", "--ike-id"), ("child-sas",)),
+        "ike_id": (("--ike",), ("uniqueid",)),
+        "child_id": (("--ike", "--ike-id", "--child"), ("child-sas", "uniqueid")),
+        "peer_id": (("--ike", "--ike-id"), ("remote-id",)),
+    }
+    # trace record of the current completion if SWANCTL_COMPLETION_TRACE is set
+    trace = None
+    # set once imports are timed for traces, see trace_imports
+    imports_traced = False
+    # set if the current completion could not get all candidates
+    partial = False
+    # set if the current completion found more candidates than it shows
+    truncated = False
+    # maximum number of candidates shown if SWANCTL_COMPLETION_MAX_CANDIDATES
+    # is not set
+    default_max_candidates = 1000
+    # exit status telling the completion script that the candidates are
+    # complete for every word starting with cur, so it may filter them itself
+    # while the word grows instead of running the script again
+    reusable_status = 3
+    # exit status telling the completion script that there are more
+    # candidates than shown
+    truncated_status = 6
+    # exit statuses telling the completion script to run _filedir or
+    # _known_hosts_real instead
+    action_statuses = {"filedir": 4, "hosts": 5}
+    # version of the output requested with --protocol: a header line
+    # followed by the NUL terminated candidates (see format_result)
+    protocol_version = "1"
+    # actions in the header, by action of the Result
+    protocol_actions = {"none": "candidates", "filedir": "filedir", "hosts": "hosts"}
+    # characters readline does not need to quote when inserting a candidate
+    plain_chars = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                            "0123456789._=@,:/+-")
 
     @classmethod
     def main(cls):
@@ -54,112 +320,1652 @@ class SwanctlAutoComplete():
         Main function. Contains the argument parser and is used as entrypoint for the
         auto completion script
         """
-        argparser = argparse.ArgumentParser()
-        argparser.add_argument("-c")
-        argparser.add_argument(
-            "-+", "--uri",
-            help="URI to strongswan vici service",
-            type=str,
-            nargs="+")
-        argparser.add_argument(
-            "--cword")
-        argparser.add_argument(
-            "--cur")
-        argparser.add_argument(
-            "--prev")
-        argparser.add_argument(
-            "--words")
-
-        known_args, _ = argparser.parse_known_args()
-
-        cls.switch_on_command(known_args)
-
-    @classmethod
-    def filter_opts(cls, orig_opts, possible_opts):
-        """
-        Filter out already existing opts (if the short opt appears,
-        do not present the long opt)
-        """
-        # special handling for conflicting options
-        # raw and pretty
-        conflicting = ["--raw", "-r", "--pretty", "-P"]
-        filtered_opts = {}
-        for opt_short, opt_long in possible_opts:
-            filtered_opts[opt_short] = 0
-            filtered_opts[opt_long] = 0
-        for word in ["--raw", "-r", "--pretty", "-P"]:
-            if word in filtered_opts:
-                for word2 in conflicting:
-                    try:
-                        filtered_opts.pop(word2)
-                    except:
-                        pass
-        for word in orig_opts:
-            for opt_short, opt_long in possible_opts:
-                if word in (opt_short, opt_long):
-                    try:
-                        filtered_opts.pop(opt_short)
-                    except:
-                        pass
-                    try:
-                        filtered_opts.pop(opt_long)
-                    except:
-                        pass
-        return filtered_opts
-
-    @classmethod
-    def filter_opts_conflicting(cls, orig_opts, possible_opts, conflicting_opts_groups):
-        """
-        Takes groups of conflicting opts and returns all
-        non-conflicting opts as keys in a dict.
-        Groups of conflicting opts can be passed into conflicting_opts_groups as such:
-        [(group1_a, group1_b), (group2_a, group2_b)]
-        orig_opts contains user passed options and possible_opts contains all further possible
-        options (e.g. for -C/--counters -a --all -n --name, ...)
-        """
-        filtered_opts = {}
-        for opt_short, opt_long in possible_opts:
-            filtered_opts[opt_short] = 0
-            filtered_opts[opt_long] = 0
-        # iterate over tuples of ((short_opt, long_opt), (short_opt, long_opt))
-        for conflicting_opts_group in conflicting_opts_groups:
-            for conflicting_opt_short_long in conflicting_opts_group:
-                for word in conflicting_opt_short_long:
-                    if word in orig_opts:
-                        for opt in itertools.chain(*conflicting_opts_group):
-                            try:
-                                filtered_opts.pop(opt)
-                            except:
-                                pass
-        for word in orig_opts:
-            for opt_short, opt_long in possible_opts:
-                if word in (opt_short, opt_long):
-                    try:
-                        filtered_opts.pop(opt_short)
-                    except:
-                        pass
+        known_args = cls.parse_args(sys.argv[1:])
+
+        if known_args.trace_summary is not None:
+            cls.summarize_trace(known_args.trace_summary)
+            sys.exit(0)
+        if known_args.watch and not known_args.server:
+            import os
+            import signal
+            state_path = cls.index_path()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                cls.watch(state_path)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                try:
+                    os.unlink(state_path)
+                except OSError:
+                    pass
+            sys.exit(0)
+        if known_args.server:
+            if known_args.watch:
+                import threading
+                watcher = threading.Thread(target=cls.watch, daemon=True)
+                watcher.start()
+            cls.serve(known_args.socket or cls.default_socket_path())
+            sys.exit(0)
+        if known_args.batch:
+            cls.batch(sys.stdin, sys.stdout)
+            sys.exit(0)
+        cls.start_trace(known_args)
+        words = cls.split_words(str(known_args.words))
+        result = cls.complete(words, known_args.cword, known_args.cur, known_args.prev,
+                              prefetch=True)
+        import time
+        begin = time.monotonic()
+        if known_args.protocol == cls.protocol_version:
+            sys.stdout.write(cls.format_result(result))
+        else:
+            print(" ".join(result.candidates))
+        sys.stdout.flush()
+        cls.trace_phase("output", begin)
+        cls.finish_trace(words, result)
+        sys.exit(cls.exit_status(result))
+
+    @classmethod
+    def parse_args(cls, argv):
+        """
+        Parse --name=value, --name value and flag arguments.
+        argparse is not used because importing it takes longer than most
+        completions. Unknown arguments are ignored.
+        """
+        values = {"cword": None, "cur": None, "prev": None, "words": None,
+                  "socket": None, "started": None, "trace-summary": None,
+                  "protocol": None}
+        flags = {"server": False, "watch": False, "batch": False}
+        # arguments whose value may be omitted, a bare --trace-summary reads
+        # SWANCTL_COMPLETION_TRACE
+        optional = ("trace-summary",)
+        argv = list(argv)
+        index = 0
+        while index < len(argv):
+            arg = argv[index]
+            index += 1
+            if not arg.startswith("--"):
+                continue
+            name, sep, value = arg[2:].partition("=")
+            if name in flags:
+                flags[name] = True
+            elif name in values:
+                if not sep and name in optional and (
+                        index == len(argv) or argv[index].startswith("--")):
+                    value = ""
+                elif not sep:
+                    # the value of e.g. --cur may start with -- itself
+                    value = argv[index] if index < len(argv) else None
+                    index += 1
+                values[name] = value
+        values.update(flags)
+        values["trace_summary"] = values.pop("trace-summary")
+        return Arguments(**values)
+
+    @classmethod
+    def default_socket_path(cls):
+        """
+        Return the path of the per-user completion server socket, in a
+        directory owned by the user
+        """
+        import os
+        path = os.environ.get("SWANCTL_COMPLETION_SOCKET")
+        if path:
+            return path
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+        if runtime_dir:
+            return os.path.join(runtime_dir, "swanctl-completion.sock")
+        return "/tmp/swanctl-completion-%d/server.sock" % os.getuid()
+
+    @classmethod
+    def serve(cls, path):
+        """
+        Run the completion server on the UNIX socket at path.
+        The server keeps one VICI session open and answers one request per
+        connection. A request consists of four lines: words, cur, prev and
+        cword, optionally followed by the version of the output protocol. The
+        response is the output of the one-shot script with that --protocol,
+        or without it its exit status on the first line, followed by its
+        output.
+        """
+        import os
+        import signal
+        import socket
+        import stat
+        # clients only trust sockets in a directory that is ours, nobody else
+        # must be able to put a socket there
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            directory_stat = os.stat(directory)
+        except OSError as e:
+            eprint("Can not create %s: %s" % (directory, e))
+            sys.exit(1)
+        if (directory_stat.st_uid != os.getuid() or
+                directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            eprint("%s has to be owned by the user and not writable by others"
+                   % directory)
+            sys.exit(1)
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                eprint("%s exists and is not a socket" % path)
+                sys.exit(1)
+            os.unlink(path)
+        old_umask = os.umask(0o077)
+        server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server_sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        server_sock.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                conn, _ = server_sock.accept()
+                with conn:
+                    conn.settimeout(2)
                     try:
-                        filtered_opts.pop(opt_long)
-                    except:
+                        cls.serve_request(conn)
+                    except OSError:
                         pass
-        return filtered_opts
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server_sock.close()
+            os.unlink(path)
+
+    @classmethod
+    def serve_request(cls, conn):
+        """
+        Read one request from conn and send back the completion result
+        """
+        with conn.makefile("r", encoding="utf-8") as request:
+            fields = [request.readline().rstrip("\n") for _ in range(5)]
+        words = cls.split_words(fields[0])
+        cls.start_trace(Arguments())
+        result = cls.complete_reconnecting(words, fields[3], fields[1], fields[2])
+        import time
+        begin = time.monotonic()
+        if fields[4] == cls.protocol_version:
+            response = cls.format_result(result)
+        else:
+            response = "%d\n%s" % (cls.exit_status(result), " ".join(result.candidates))
+        conn.sendall(response.encode("utf-8"))
+        cls.trace_phase("output", begin)
+        cls.finish_trace(words, result)
+
+    @classmethod
+    def complete_reconnecting(cls, words, cword, cur, prev):
+        """
+        Run complete in a long running process, which keeps its VICI
+        sessions between completions. If that fails, most likely charon was
+        restarted and the session is dead, so it is retried once with a new
+        session. Returns an empty result if that fails as well.
+        """
+        try:
+            return cls.complete(words, cword, cur, prev)
+        except Exception:
+            cls.drop_session()
+        try:
+            return cls.complete(words, cword, cur, prev)
+        except Exception:
+            cls.drop_session()
+            return Result()
+
+    @classmethod
+    def batch(cls, requests, responses):
+        """
+        Answer completion requests read as JSON lines from the file requests
+        in one process, which keeps its VICI sessions for all of them.
+        A request is an object with words (a list or the command line as
+        passed by the completion script) and cword, cur and prev default to
+        the words at and before cword. For every request, a JSON line with
+        the candidates, action, filtered, reusable and truncated of its result (and
+        its id, if it has one) or with an error is written to responses.
+        """
+        import json
+        for line in requests:
+            if not line.strip():
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                words = request["words"]
+                if isinstance(words, str):
+                    words = cls.split_words(words)
+                cword = int(request["cword"])
+                cur = request.get("cur", words[cword] if cword < len(words) else "")
+                prev = request.get("prev", words[cword - 1])
+            except (ValueError, KeyError, TypeError, IndexError, AttributeError) as exc:
+                response = {"error": "invalid request: %s" % exc}
+            else:
+                cls.start_trace(Arguments())
+                result = cls.complete_reconnecting(words, cword, cur, prev)
+                cls.finish_trace(words, result)
+                response = {"candidates": result.candidates, "action": result.action,
+                            "filtered": result.filtered, "reusable": result.reusable,
+                            "truncated": result.truncated}
+            if isinstance(request, dict) and "id" in request:
+                response["id"] = request["id"]
+            responses.write(json.dumps(response) + "\n")
+            responses.flush()
+
+    @classmethod
+    def format_result(cls, result):
+        """
+        Format a Result for the completion script: a header line with
+        "swanctl-completion", the protocol version, the action (candidates,
+        filedir, hosts or none) and the flags filtered, reusable and truncated
+        that are set, separated by commas ("-" if none is), followed by the
+        candidates, each terminated by a NUL character. Candidates may contain
+        any other character, the flag quote is set if readline has to quote
+        some of them.
+        """
+        action = cls.protocol_actions[result.action]
+        if action == "candidates" and not result.candidates:
+            action = "none"
+        flags = [flag for flag in ("filtered", "reusable", "truncated")
+                 if getattr(result, flag)]
+        # checking the characters in bash would take longer than the rest
+        if not cls.plain_chars.issuperset("".join(result.candidates)):
+            flags.append("quote")
+        return "swanctl-completion %s %s %s\n%s" % (
+            cls.protocol_version, action, ",".join(flags) or "-",
+            "".join(candidate + "\0" for candidate in result.candidates))
+
+    @classmethod
+    def exit_status(cls, result):
+        """
+        Return the exit status of the one-shot script for a Result
+        """
+        if result.action in cls.action_statuses:
+            return cls.action_statuses[result.action]
+        if result.truncated:
+            return cls.truncated_status
+        if result.reusable:
+            return cls.reusable_status
+        return 0
+
+    @classmethod
+    def start_trace(cls, args):
+        """
+        Start the trace record of one completion if SWANCTL_COMPLETION_TRACE
+        names a file to append it to. The time bash needed to start the
+        script is known if it passed $EPOCHREALTIME as --started.
+        """
+        import os
+        path = os.environ.get("SWANCTL_COMPLETION_TRACE")
+        if not path:
+            cls.trace = None
+            return
+        import time
+        cls.trace = {"path": path, "begin": time.monotonic(), "handler": None,
+                     "cache": [], "phases": {}}
+        cls.trace_imports()
+        started = getattr(args, "started", None)
+        if started:
+            try:
+                # the decimal point of $EPOCHREALTIME depends on the locale
+                startup = time.time() - float(started.replace(",", "."))
+                cls.trace["phases"]["startup"] = [startup]
+            except ValueError:
+                pass
+
+    @classmethod
+    def trace_imports(cls):
+        """
+        Time the imports of modules that are not loaded yet as the phase
+        "imports" of the current trace, by wrapping __import__ once the first
+        trace is started. Nested imports count for the outermost one.
+        """
+        if cls.imports_traced:
+            return
+        cls.imports_traced = True
+        import _thread
+        import builtins
+        import time
+        original_import = builtins.__import__
+        importing = set()
+
+        def timed_import(name, *args, **kwargs):
+            ident = _thread.get_ident()
+            if cls.trace is None or name in sys.modules or ident in importing:
+                return original_import(name, *args, **kwargs)
+            importing.add(ident)
+            begin = time.monotonic()
+            try:
+                return original_import(name, *args, **kwargs)
+            finally:
+                importing.discard(ident)
+                cls.trace_phase("imports", begin)
+
+        builtins.__import__ = timed_import
+
+    @classmethod
+    def trace_phase(cls, phase, begin):
+        """
+        Add the time since begin (from time.monotonic) to a phase of the
+        current trace. Phases running in several threads add up.
+        """
+        if cls.trace is not None:
+            import time
+            cls.trace["phases"].setdefault(phase, []).append(time.monotonic() - begin)
+
+    @classmethod
+    def trace_handler(cls, handler):
+        """
+        Record which handler answers the current completion
+        """
+        if cls.trace is not None:
+            cls.trace["handler"] = handler
+
+    @classmethod
+    def finish_trace(cls, words, result):
+        """
+        Append the trace record of the completion as a JSON line to the trace
+        file. Timings are in milliseconds. "query" is the time spent in VICI
+        queries (including receiving and decoding the answers) without
+        connecting, "other" is everything that is not part of a phase.
+        "imports" happen within the other phases (e.g. socket while
+        connecting), so they are not subtracted from "other".
+        """
+        if cls.trace is None:
+            return
+        import time
+        trace = cls.trace
+        cls.trace = None
+        total = time.monotonic() - trace["begin"]
+        import json
+        timings = {phase: sum(times) for phase, times in trace["phases"].items()}
+        if "vici" in timings:
+            timings["query"] = max(0, timings.pop("vici") - timings.get("connect", 0))
+        timings["other"] = max(0, total - sum(timing for phase, timing in timings.items()
+                                              if phase not in ("startup", "imports")))
+        timings["total"] = total
+        record = {
+            "time": round(time.time(), 3),
+            "command": words[1] if len(words) > 1 else None,
+            "handler": trace["handler"],
+            "status": cls.exit_status(result),
+            "candidates": len(result.candidates),
+            "cache": trace["cache"],
+            "ms": {phase: round(timing * 1000, 3) for phase, timing in timings.items()},
+        }
+        try:
+            with open(trace["path"], "a") as trace_file:
+                trace_file.write(json.dumps(record, sort_keys=True) + "\n")
+        except OSError:
+            pass
+
+    @classmethod
+    def summarize_trace(cls, path):
+        """
+        Print the number of completions and the p50/p90/p99 of the total time
+        and of every phase per handler from a trace file. path defaults to
+        SWANCTL_COMPLETION_TRACE.
+        """
+        import json
+        import os
+        path = path or os.environ.get("SWANCTL_COMPLETION_TRACE")
+        if not path:
+            eprint("No trace file given")
+            sys.exit(1)
+        timings = {}
+        cache_hits = {}
+        with open(path) as trace_file:
+            for line in trace_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                handler = record.get("handler") or "-"
+                for phase, timing in record.get("ms", {}).items():
+                    timings.setdefault(handler, {}).setdefault(phase, []).append(timing)
+                hits = cache_hits.setdefault(handler, [0, 0])
+                for state in record.get("cache", ()):
+                    hits[0] += not state.endswith(":miss")
+                    hits[1] += 1
+
+        def percentile(values, fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))]
+
+        phases = ["total", "startup", "imports", "connect", "query", "cache", "output",
+                  "other"]
+        print("%-16s %6s %6s  %-8s %10s %10s %10s"
+              % ("handler", "count", "hits", "phase", "p50 ms", "p90 ms", "p99 ms"))
+        for handler in sorted(timings, key=lambda name: -len(timings[name]["total"])):
+            hits, lookups = cache_hits[handler]
+            label = (handler, str(len(timings[handler]["total"])),
+                     "%d%%" % (100 * hits / lookups) if lookups else "-")
+            for phase in phases:
+                values = sorted(timings[handler].get(phase, ()))
+                if not values:
+                    continue
+                print("%-16s %6s %6s  %-8s %10.1f %10.1f %10.1f"
+                      % (label + (phase, percentile(values, 0.5),
+                                  percentile(values, 0.9), percentile(values, 0.99))))
+                label = ("", "", "")
+
+    @classmethod
+    def compile_grammar(cls):
+        """
+        Compile the grammar into lookup tables, once per process.
+        Returns a dict mapping both names of every command to a dict with
+          options:   option (short or long) -> long option
+          order:     (option, long option) in the order they are suggested
+          excludes:  long option -> frozenset of long options it rules out
+          values:    long option -> how to complete its value
+        """
+        if cls.compiled_grammar is not None:
+            return cls.compiled_grammar
+        compiled = {}
+        for command in cls.grammar:
+            spec = {"options": {}, "order": [], "excludes": {}, "values": {}}
+            for part in (command, cls.general_grammar):
+                for opt_short, opt_long in part.get("options", ()):
+                    spec["options"][opt_short] = opt_long
+                    spec["options"][opt_long] = opt_long
+                    spec["order"].extend(((opt_short, opt_long), (opt_long, opt_long)))
+                for group in part.get("conflicts", ()):
+                    for opt_long in group:
+                        spec["excludes"][opt_long] = frozenset(
+                            spec["excludes"].get(opt_long, frozenset()) | set(group))
+                spec["values"].update(part.get("values", {}))
+            for name in command["command"]:
+                compiled[name] = spec
+        cls.compiled_grammar = compiled
+        return compiled
+
+    @classmethod
+    def scan_words(cls, spec, words, cword):
+        """
+        Collect the options used on the command line in one pass over words,
+        skipping the binary, the command and the word being completed.
+        Returns the set of used long options and a dict of the values given
+        to options, by long option.
+        """
+        used = set()
+        given = {}
+        index = 2
+        while index < len(words):
+            if index == cword:
+                index += 1
+                continue
+            name, sep, value = words[index].partition("=")
+            opt_long = spec["options"].get(name)
+            if opt_long is not None:
+                used.add(opt_long)
+                if opt_long in spec["values"]:
+                    if sep:
+                        given[opt_long] = value
+                    elif (index + 1 < len(words) and index + 1 != cword and
+                          not words[index + 1].startswith("-")):
+                        given[opt_long] = words[index + 1]
+                        index += 1
+            index += 1
+        return used, given
+
+    @classmethod
+    def vici_uris(cls):
+        """
+        Return the URIs of the VICI sockets to query: the one given with
+        --uri on the command line, or the list of URIs separated by spaces or
+        commas in SWANCTL_COMPLETION_VICI_URI, or the default URI
+        """
+        if cls.uris:
+            return cls.uris
+        import os
+        uris = os.environ.get("SWANCTL_COMPLETION_VICI_URI", "").replace(",", " ").split()
+        return uris or [cls.default_vici_uri]
+
+    @classmethod
+    def current_uri(cls):
+        """
+        Return the URI of the VICI socket the calling thread queries
+        """
+        import threading
+        return cls.thread_uris.get(threading.get_ident()) or cls.vici_uris()[0]
+
+    @classmethod
+    def session_key(cls):
+        """
+        Return the key of the session of the calling thread in sessions
+        """
+        import threading
+        return threading.get_ident(), cls.current_uri()
+
+    @classmethod
+    def connect_session(cls, timeout=None):
+        """
+        Open a new VICI session to the URI queried by the calling thread.
+        timeout is set on the socket, so it applies to connecting and to
+        every later receive. Raises an exception if the connection fails.
+        """
+        import socket
+        import urllib.parse
+        uri = cls.current_uri()
+        parse_result = urllib.parse.urlsplit(uri)
+        if parse_result.scheme == "unix":
+            address = parse_result.path
+            custom_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif parse_result.scheme == "tcp":
+            address = (parse_result.hostname, parse_result.port)
+            custom_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            # no message, this runs while the user presses TAB
+            raise ValueError("Unsupported URL scheme %s" % parse_result.scheme)
+        try:
+            custom_sock.settimeout(timeout)
+            custom_sock.connect(address)
+        except BaseException:
+            custom_sock.close()
+            raise
+        return ViciSession(custom_sock)
+
+    @classmethod
+    def get_session(cls):
+        """
+        Return the VICI session of the calling thread. Sessions are kept on
+        the class so a long running completion server can reuse them for
+        every request.
+        The socket timeout is set to the time left until the deadline.
+        Raises TimeoutError if the deadline has passed and ViciConnectError
+        if charon is not reachable.
+        """
+        cls.rate_limit()
+        session = cls.sessions.get(cls.session_key())
+        if session is not None and session.sock.fileno() != -1:
+            session.sock.settimeout(cls.remaining())
+            return session
+        import time
+        begin = time.monotonic()
+        try:
+            session = cls.connect_session(cls.remaining())
+            cls.trace_phase("connect", begin)
+            cls.sessions[cls.session_key()] = session
+            return session
+        except TimeoutError:
+            raise
+        except:
+            pass
+        cls.partial = True
+        raise ViciConnectError("can not connect to %s" % cls.current_uri())
+
+    @classmethod
+    def rate_limit(cls):
+        """
+        Take a token from the rate limit of VICI queries, a token bucket
+        shared by all completions using the same file (SWANCTL_COMPLETION_RATE_FILE,
+        by default vici-rate in the cache directory). The rate is configured in
+        queries per second via SWANCTL_COMPLETION_RATE_LIMIT, 0 disables it.
+        Waits for a token if there is none. Raises TimeoutError if there will
+        be none before the deadline.
+        """
+        import fcntl
+        import os
+        import struct
+        import time
+        try:
+            rate = float(os.environ.get("SWANCTL_COMPLETION_RATE_LIMIT", cls.default_rate_limit))
+        except ValueError:
+            rate = cls.default_rate_limit
+        if rate <= 0:
+            return
+        path = os.environ.get("SWANCTL_COMPLETION_RATE_FILE") or os.path.join(
+            cls.cache_dir(), "vici-rate")
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            rate_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            cls.share_cache_file(rate_fd)
+        except OSError:
+            # no limit if it can not be shared
+            return
+        try:
+            while True:
+                fcntl.flock(rate_fd, fcntl.LOCK_EX)
+                try:
+                    now = time.time()
+                    state = os.pread(rate_fd, 16, 0)
+                    tokens, updated = struct.unpack("<dd", state) if len(state) == 16 else (rate, now)
+                    # the bucket holds at most one second worth of queries
+                    tokens = min(rate, tokens + max(0, now - updated) * rate)
+                    if tokens >= 1:
+                        os.pwrite(rate_fd, struct.pack("<dd", tokens - 1, now), 0)
+                        return
+                    os.pwrite(rate_fd, struct.pack("<dd", tokens, now), 0)
+                finally:
+                    fcntl.flock(rate_fd, fcntl.LOCK_UN)
+                wait = (1 - tokens) / rate
+                remaining = cls.remaining()
+                if remaining is not None and wait > remaining:
+                    raise TimeoutError("VICI rate limit exceeded")
+                time.sleep(wait)
+        finally:
+            os.close(rate_fd)
+
+    @classmethod
+    def drop_session(cls):
+        """
+        Close the session of the calling thread, e.g. after a timeout left
+        unread data in it
+        """
+        session = cls.sessions.pop(cls.session_key(), None)
+        if session is not None:
+            session.sock.close()
+
+    @classmethod
+    def start_deadline(cls):
+        """
+        Start the time budget of one completion, configured in milliseconds
+        via SWANCTL_COMPLETION_TIMEOUT. 0 disables the deadline.
+        """
+        import os
+        import time
+        try:
+            budget = float(os.environ.get("SWANCTL_COMPLETION_TIMEOUT",
+                                          cls.default_timeout)) / 1000
+        except ValueError:
+            budget = cls.default_timeout / 1000
+        cls.deadline = time.monotonic() + budget if budget > 0 else None
+
+    @classmethod
+    def remaining(cls):
+        """
+        Return the seconds left until the deadline or None if there is none.
+        Raises TimeoutError if the deadline has passed.
+        """
+        import time
+        if cls.deadline is None:
+            return None
+        remaining = cls.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("completion deadline exceeded")
+        return remaining
+
+    @classmethod
+    def stream(cls, items):
+        """
+        Yield the items of a streamed VICI response, shortening the socket
+        timeout to the time left until the deadline before each of them
+        """
+        session = cls.sessions.get(cls.session_key())
+        iterator = iter(items)
+        while True:
+            if session is not None:
+                session.sock.settimeout(cls.remaining())
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+
+    @classmethod
+    def record_timeout(cls, query, partial):
+        """
+        Append a record about a completion that ran out of time to the
+        timeout log (SWANCTL_COMPLETION_TIMEOUT_LOG, by default timeouts.log
+        in the cache directory)
+        """
+        import json
+        import os
+        import time
+        path = os.environ.get("SWANCTL_COMPLETION_TIMEOUT_LOG") or os.path.join(
+            cls.cache_dir(), "timeouts.log")
+        record = {"time": time.time(), "uri": cls.current_uri(),
+                  "query": query, "partial": partial}
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as log_file:
+                cls.share_cache_file(log_file.fileno())
+                log_file.write(json.dumps(record) + "\n")
+        except OSError:
+            pass
+
+    @classmethod
+    def index_path(cls):
+        """
+        Return the path of the SA index snapshot for the VICI socket
+        queried by the calling thread
+        """
+        import os
+        # named after the URI itself, as json and hashlib for cache_path take
+        # longer to import than looking up names in the index
+        return os.path.join(cls.cache_dir(),
+                            "sa-index-%s" % cls.current_uri().encode("utf-8").hex())
+
+    @classmethod
+    def get_sa_index(cls):
+        """
+        Return the SA index maintained by a running watcher or None.
+        The completion server holds the index in memory, other processes
+        look up names in the snapshot written by the watcher (see
+        SaIndexFile).
+        """
+        import os
+        import time
+        begin = time.monotonic()
+        if len(cls.vici_uris()) != 1:
+            # the index only covers one endpoint
+            return None
+        if cls.sa_index is not None:
+            if not cls.sa_index.synced or cls.current_uri() != cls.watched_uri:
+                return None
+            cls.trace_cache("sas", "index", begin)
+            return cls.sa_index
+        snapshot = cls.read_cache(cls.index_path())
+        if snapshot is None:
+            return None
+        limit = cls.max_candidates()
+        index = SaIndexFile(snapshot, limit + 1 if limit else None)
+        try:
+            # a snapshot without a live watcher may be missing events
+            os.kill(index.pid(), 0)
+        except PermissionError:
+            # the watcher of another user sharing the cache directory
+            pass
+        except (OSError, ValueError, IndexError, OverflowError):
+            snapshot.close()
+            return None
+        cls.trace_cache("sas", "index", begin)
+        return index
+
+    @classmethod
+    def watch(cls, state_path=None):
+        """
+        Maintain the SA index from VICI events. A full resync is done on
+        startup, after losing the connection to charon and whenever an event
+        does not match the index, which means that an event was missed.
+        If state_path is given, the index is written to it as well.
+        """
+        import threading
+        import time
+        index = SaIndex()
+        # keep watching the same endpoint while a completion server answers
+        # requests with other URIs
+        cls.watched_uri = cls.vici_uris()[0]
+        cls.thread_uris[threading.get_ident()] = cls.watched_uri
+        cls.sa_index = index
+        if state_path:
+            flusher = threading.Thread(target=cls.flush_index,
+                                       args=(index, state_path), daemon=True)
+            flusher.start()
+        while True:
+            listen_session = None
+            try:
+                # register before the resync, events arriving in the meantime
+                # are buffered in the socket
+                listen_session = cls.connect_session()
+                for event in SaIndex.events:
+                    listen_session.register(event)
+                resync_session = cls.connect_session()
+                try:
+                    index.resync(resync_session)
+                finally:
+                    resync_session.sock.close()
+                for label, event in listen_session.listen():
+                    if not index.apply_event(label, vici_decode(event)):
+                        break
+            except Exception:
+                index.synced = False
+                time.sleep(cls.watch_retry_interval)
+            finally:
+                if listen_session is not None:
+                    listen_session.sock.close()
+
+    @classmethod
+    def flush_index(cls, index, state_path):
+        """
+        Periodically write the index to state_path if it changed
+        """
+        import os
+        import time
+        written = None
+        while True:
+            begin = time.monotonic()
+            if index.synced and index.generation != written:
+                with index.lock:
+                    written = index.generation
+                    records = list(index.records())
+                records.append(SaIndexFile.key("pid") + str(os.getpid()))
+                try:
+                    os.makedirs(os.path.dirname(state_path), mode=0o700, exist_ok=True)
+                    Snapshot.write(state_path, records, time.time(),
+                                   0o660 if cls.cache_shared() else None)
+                except OSError:
+                    pass
+            # writing the index of many SAs takes a while, do not spend more
+            # than a fifth of the time on it while SAs keep changing
+            time.sleep(max(cls.index_flush_interval, 4 * (time.monotonic() - begin)))
+
+    @classmethod
+    def cache_ttl(cls, kind):
+        """
+        Return the time to live in seconds of cached results of the given kind.
+        The defaults can be overridden with SWANCTL_COMPLETION_CACHE_TTL,
+        e.g. "sas=1,conns=60". A TTL of 0 disables caching for that kind.
+        """
+        import os
+        ttls = dict(cls.cache_ttls)
+        for setting in os.environ.get("SWANCTL_COMPLETION_CACHE_TTL", "").split(","):
+            kind_name, _, ttl = setting.partition("=")
+            try:
+                ttls[kind_name.strip()] = float(ttl)
+            except ValueError:
+                pass
+        return ttls.get(kind, 0)
+
+    @classmethod
+    def cache_path(cls, query):
+        """
+        Return the path of the cache file for the given query on the
+        VICI socket queried by the calling thread
+        """
+        import hashlib
+        import json
+        import os
+        key = json.dumps([cls.current_uri(), query], sort_keys=True)
+        return os.path.join(cls.cache_dir(), hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    @classmethod
+    def cache_dir(cls):
+        """
+        Return the directory of the cache files
+        """
+        import os
+        cache_dir = os.environ.get("SWANCTL_COMPLETION_CACHE_DIR")
+        if not cache_dir:
+            cache_dir = os.path.join(
+                os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                "swanctl-completion")
+        return cache_dir
+
+    @classmethod
+    def cache_shared(cls):
+        """
+        Return True if the cache directory is shared by the users of a group,
+        which is the case if it is writable by the group
+        """
+        import os
+        import stat
+        try:
+            return bool(os.stat(cls.cache_dir()).st_mode & stat.S_IWGRP)
+        except OSError:
+            return False
+
+    @classmethod
+    def share_cache_file(cls, fd):
+        """
+        Make a file created in the cache directory readable and writable by
+        the group if the cache directory is shared. Files are private
+        otherwise.
+        """
+        import os
+        if cls.cache_shared():
+            try:
+                os.fchmod(fd, 0o660)
+            except OSError:
+                # created by another user, who already did it
+                pass
+
+    @classmethod
+    def read_cache(cls, path):
+        """
+        Return the Snapshot stored at path or None. A snapshot from the
+        future is ignored, as it would never expire.
+        """
+        import time
+        try:
+            snapshot = Snapshot(path)
+        except (OSError, ValueError):
+            return None
+        if not snapshot.timestamp <= time.time():
+            snapshot.close()
+            return None
+        return snapshot
+
+    @classmethod
+    def write_cache(cls, path, data):
+        """
+        Atomically replace the cache file at path
+        """
+        import os
+        import time
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            Snapshot.write(path, data, time.time(), 0o660 if cls.cache_shared() else None)
+        except OSError:
+            pass
+        cls.cleanup_cache()
+
+    @classmethod
+    def cleanup_cache(cls):
+        """
+        Remove the cache files of queries that were not written for
+        cache_max_age, with their lock files, and temporary files left
+        behind, as every filter value gets its own cache file. The directory
+        is scanned at most once per cache_cleanup_interval, which the mtime
+        of the "cleanup" file keeps track of.
+        """
+        import os
+        import time
+        now = time.time()
+        stamp_path = os.path.join(cls.cache_dir(), "cleanup")
+        try:
+            if now - os.stat(stamp_path).st_mtime < cls.cache_cleanup_interval:
+                return
+        except OSError:
+            pass
+        try:
+            fd = os.open(stamp_path, os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                cls.share_cache_file(fd)
+                os.utime(fd)
+            finally:
+                os.close(fd)
+            entries = list(os.scandir(cls.cache_dir()))
+        except OSError:
+            return
+        names = set(entry.name for entry in entries)
+        # cache files first, so their lock files go in the same scan
+        for entry in sorted(entries, key=lambda entry: "." in entry.name):
+            query, _, suffix = entry.name.partition(".")
+            if len(query) == 40 and not query.strip("0123456789abcdef"):
+                # a lock or refresh lock is kept while its cache file exists
+                if suffix not in ("", "lock", "refresh") or (suffix and query in names):
+                    continue
+            elif not entry.name.startswith("tmp"):
+                # not written per query, like the SA index or swanctl-conf
+                continue
+            try:
+                if now - entry.stat().st_mtime >= cls.cache_max_age:
+                    os.unlink(entry.path)
+                    names.discard(entry.name)
+            except OSError:
+                pass
+
+    @classmethod
+    def run_in_background(cls, lock_path, function):
+        """
+        Call function in a detached process with its own VICI sessions and
+        the time budget of a cache refresh. Nothing is started while another
+        process holding lock_path runs.
+        """
+        import os
+        import time
+        try:
+            if time.time() - os.stat(lock_path).st_mtime > cls.refresh_lock_timeout:
+                os.unlink(lock_path)
+        except OSError:
+            pass
+        try:
+            os.makedirs(os.path.dirname(lock_path), mode=0o700, exist_ok=True)
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+        except OSError:
+            # another one is already running
+            return
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        # double fork so the process neither becomes a zombie nor keeps the
+        # pipe of the completion script open
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            # never share the VICI connection with the parent
+            cls.sessions = {}
+            # nor any other inherited file, e.g. the client connection of
+            # the completion server, which would not see EOF until we exit
+            os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+            cls.trace = None
+            cls.deadline = time.monotonic() + cls.refresh_timeout
+            function()
+        except BaseException:
+            pass
+        finally:
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            os._exit(0)
+
+    @classmethod
+    def refresh_in_background(cls, path, fetch, uri=None):
+        """
+        Run fetch in a detached process and store its result at path.
+        Only one refresh per cache file runs at a time. In a gather worker
+        the refresh is deferred until all workers are done, as forking while
+        other threads run can deadlock the child.
+        """
+        import threading
+        uri = uri or cls.current_uri()
+        deferred = cls.deferred_refreshes.get(threading.get_ident())
+        if deferred is not None:
+            deferred.append((path, fetch, uri))
+            return
+
+        def refresh():
+            cls.thread_uris = {threading.get_ident(): uri}
+            lock_fd, names = cls.join_flight(path)
+            if names is None:
+                cls.write_cache(path, list(fetch()))
+            cls.leave_flight(lock_fd)
+
+        cls.run_in_background(path + ".refresh", refresh)
+
+    @classmethod
+    def prefetch(cls, handlers, given):
+        """
+        Run the given value handlers (a dict by value name) in a detached
+        process to fill the cache, so completing the value of an option does
+        not wait for charon. The SA data of all of them is fetched with a
+        single list-sas first (see prefetch_sas), so those handlers only read
+        the cache. Only one prefetch runs at a time, and none if the cache is
+        disabled or SWANCTL_COMPLETION_PREFETCH is 0.
+        """
+        import os
+        if not handlers or os.environ.get("SWANCTL_COMPLETION_PREFETCH", "1") == "0":
+            return
+        if cls.cache_ttl("sas") <= 0:
+            # nothing to gain from fetching SA data that is not cached
+            handlers = {value: handler for value, handler in handlers.items()
+                        if value not in cls.sa_queries}
+        if not handlers or cls.cache_ttl("conns") <= 0 and cls.cache_ttl("sas") <= 0:
+            return
+
+        def run_handlers():
+            # the cache needs all names, not the ones to show
+            os.environ["SWANCTL_COMPLETION_MAX_CANDIDATES"] = "0"
+            # the SA index does not cover remote identities
+            index = cls.get_sa_index()
+            values = [value for value in handlers if value in cls.sa_queries and
+                      (index is None or value == "peer_id")]
+            if values:
+                cls.prefetch_sas(values, given)
+            for handler in handlers.values():
+                try:
+                    handler(given)
+                except Exception:
+                    pass
+
+        cls.run_in_background(os.path.join(cls.cache_dir(), "prefetch.refresh"),
+                              run_handlers)
+
+    @classmethod
+    def prefetch_sas(cls, values, given):
+        """
+        Fill the cache of the SA data of the given value handlers (see
+        sa_queries) from one list-sas of all IKE_SAs per VICI socket,
+        instead of one list-sas per handler. Values whose cache is still
+        fresh are skipped, and so is the list-sas if all of them are.
+        """
+        import threading
+        import time
+        paths = [("*",), ("*", "uniqueid"), ("*", "remote-id"), ("*", "child-sas", "*"),
+                 ("*", "child-sas", "*", "name"), ("*", "child-sas", "*", "uniqueid")]
+        ttl = cls.cache_ttl("sas")
+        for uri in cls.vici_uris():
+            cls.thread_uris[threading.get_ident()] = uri
+            stale = []
+            for value in values:
+                snapshot = cls.read_cache(cls.cache_path(cls.sa_query(value, given)))
+                if snapshot is None:
+                    stale.append(value)
+                    continue
+                if time.time() - snapshot.timestamp >= ttl:
+                    stale.append(value)
+                snapshot.close()
+            if not stale:
+                continue
+            ike_sas = []
+            try:
+                for section in vici_sections(
+                        cls.extract("list-sas", "list-sa", cls.sa_filters(), paths)):
+                    names = section[None]
+                    if len(names) == 1:
+                        ike_sas.append((names[0], section, []))
+                    elif ike_sas:
+                        # newer charon versions key CHILD_SAs by name-uniqueid
+                        ike_sas[-1][2].append((section.get("name", names[-1]),
+                                               section.get("uniqueid")))
+            except Exception:
+                # incomplete, leave it to the handlers
+                continue
+            finally:
+                cls.drop_session()
+            for value in stale:
+                options, data = cls.sa_queries[value]
+                ike, ike_id, child = (given.get(option) if option in options else None
+                                      for option in ("--ike", "--ike-id", "--child"))
+                names = []
+                for name, ike_sa, children in ike_sas:
+                    if ike and name != ike or ike_id and ike_sa.get("uniqueid") != ike_id:
+                        continue
+                    if not data:
+                        names.append(name)
+                    elif data[0] != "child-sas":
+                        names.append(ike_sa.get(data[0]))
+                    else:
+                        names.extend(child_id if data[1:] else child_name
+                                     for child_name, child_id in children
+                                     if not child or child_name == child)
+                cls.write_cache(cls.cache_path(cls.sa_query(value, given)),
+                                [name for name in names if name is not None])
+        cls.thread_uris.pop(threading.get_ident(), None)
+
+    @classmethod
+    def sa_query(cls, value, given):
+        """
+        Return the cache query of the SA data of the given value handler for
+        the given options (see sa_queries)
+        """
+        options, data = cls.sa_queries[value]
+        return ["list-sas", {option[2:]: given.get(option) for option in options}] + list(data)
+
+    @classmethod
+    def cached_query(cls, kind, query, fetch, prefix=""):
+        """
+        Return the results of fetch() for the given query that start with
+        prefix, using the on-disk cache. kind selects the TTL (see cache_ttls),
+        query is a JSON serialisable description of the VICI query including
+        its filters, or a function returning it, which is called for the VICI
+        socket to query. fetch is a generator function.
+        Expired entries are returned right away and refreshed in the
+        background. If the deadline is hit, the results received so far are
+        returned and the cache is filled in the background.
+        If another completion runs the same query, its result is awaited
+        instead of querying charon again. If charon closes the socket or
+        sends a malformed message, the names received so far are returned.
+        """
+        import time
+        if callable(query):
+            begin = time.monotonic()
+            try:
+                query = query()
+            except TimeoutError:
+                cls.record_timeout(["stats"], 0)
+                cls.partial = True
+                return []
+            except (OSError, IndexError, ValueError):
+                # charon closed the socket or sent a malformed message
+                cls.drop_session()
+                cls.partial = True
+                return []
+            cls.trace_phase("vici", begin)
+        begin = time.monotonic()
+        ttl = cls.cache_ttl(kind)
+        # the cache file also passes the result on to concurrent completions
+        # running the same query, even if the cache is disabled
+        path = cls.cache_path(query)
+        snapshot = cls.read_cache(path) if ttl > 0 else None
+        if snapshot is not None:
+            stale = time.time() - snapshot.timestamp >= ttl
+            try:
+                limit = cls.max_candidates()
+                names = snapshot.lookup(prefix, limit + 1 if limit else None)
+            except ValueError:
+                # a corrupt snapshot is a miss, it is replaced below
+                names = None
+            finally:
+                snapshot.close()
+            if names is not None:
+                if stale:
+                    cls.refresh_in_background(path, fetch)
+                cls.trace_cache(kind, "stale" if stale else "hit", begin)
+                return cls.match_prefix(names, prefix)
+        try:
+            lock_fd, names = cls.join_flight(path, prefix)
+        except TimeoutError:
+            cls.record_timeout(query, 0)
+            cls.partial = True
+            return []
+        if names is not None:
+            cls.trace_cache(kind, "shared", begin)
+            return cls.match_prefix(names, prefix)
+        if cls.trace is not None:
+            cls.trace_cache(kind, "miss", begin)
+            begin = time.monotonic()
+        limit = cls.max_candidates()
+        for attempt in range(2):
+            names = []
+            matches = set()
+            stopped = timed_out = broken = False
+            try:
+                for name in fetch():
+                    names.append(name)
+                    if limit and name.startswith(prefix or ""):
+                        matches.add(name)
+                        if len(matches) > limit:
+                            stopped = True
+                            break
+            except TimeoutError:
+                timed_out = True
+            except (OSError, IndexError, ValueError):
+                # charon closed the socket or sent a malformed message
+                broken = True
+            except BaseException:
+                cls.leave_flight(lock_fd)
+                raise
+            if not broken:
+                break
+            cls.drop_session()
+            if names or attempt:
+                break
+            # most likely a session kept by the completion server to a
+            # charon that was restarted since, retry once with a new one
+        cls.trace_phase("vici", begin)
+        if broken:
+            cls.leave_flight(lock_fd)
+            cls.partial = True
+            return cls.match_prefix(names, prefix)
+        if not timed_out and not stopped:
+            begin = time.monotonic()
+            cls.write_cache(path, names)
+            cls.trace_phase("cache", begin)
+        # release the lock before forking a refresh, which would inherit it
+        cls.leave_flight(lock_fd)
+        if timed_out:
+            cls.record_timeout(query, len(names))
+            cls.drop_session()
+            cls.partial = True
+            cls.refresh_in_background(path, fetch)
+        elif stopped:
+            # there are more names than shown, do not wait for the rest. It
+            # is left unread in the session, which can not be used anymore.
+            cls.drop_session()
+            cls.refresh_in_background(path, fetch)
+        return cls.match_prefix(names, prefix)
+
+    @classmethod
+    def join_flight(cls, path, prefix=""):
+        """
+        Coalesce identical queries of concurrent completions by taking the
+        lock of the query cached at path. If another process holds it, wait
+        until it is done and use the result it wrote to path.
+        Returns (lock, None) if the caller has to run the query and release
+        the lock with leave_flight afterwards, or (None, names) with the
+        names starting with prefix that the other process fetched.
+        Raises TimeoutError if the other process is not done in time.
+        """
+        import fcntl
+        import os
+        import time
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            cls.share_cache_file(lock_fd)
+        except OSError:
+            # no coalescing if there is no cache directory
+            return None, None
+        started = time.time()
+        waited = False
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                pass
+            waited = True
+            try:
+                remaining = cls.remaining()
+                if remaining is None:
+                    remaining = started + cls.refresh_timeout - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("concurrent query not done in time")
+            except TimeoutError:
+                os.close(lock_fd)
+                raise
+            time.sleep(min(cls.flight_poll_interval, remaining))
+        if waited:
+            snapshot = cls.read_cache(path)
+            if snapshot is not None:
+                try:
+                    if snapshot.timestamp >= started:
+                        limit = cls.max_candidates()
+                        names = snapshot.lookup(prefix, limit + 1 if limit else None)
+                        os.close(lock_fd)
+                        return None, names
+                except ValueError:
+                    pass
+                finally:
+                    snapshot.close()
+            # the other process failed, query charon ourselves
+        return lock_fd, None
+
+    @classmethod
+    def leave_flight(cls, lock_fd):
+        """
+        Release a lock taken by join_flight
+        """
+        if lock_fd is not None:
+            import os
+            os.close(lock_fd)
+
+    @classmethod
+    def trace_cache(cls, kind, state, begin):
+        """
+        Record a cache lookup of the given kind of data in the current trace.
+        state is "hit", "stale" or "miss", begin is when the lookup started.
+        """
+        if cls.trace is not None:
+            cls.trace["cache"].append("%s:%s" % (kind, state))
+            cls.trace_phase("cache", begin)
+
+    @classmethod
+    def gather(cls, queries, prefix=""):
+        """
+        Run cached_query for each (kind, query, fetch) tuple in queries on
+        every VICI socket to query concurrently, each in its own thread with
+        its own VICI session, and return the unique names starting with
+        prefix in the order in which the results arrive.
+        Every endpoint has the whole time budget, an endpoint that is slow or
+        not reachable only loses its own names.
+        """
+        import queue
+        import threading
+        uris = cls.vici_uris()
+        if len(queries) == 1 and len(uris) == 1:
+            return cls.cached_query(*queries[0], prefix)
+        results = queue.Queue()
+
+        def worker(uri, kind, query, fetch):
+            names = []
+            refreshes = []
+            cls.thread_uris[threading.get_ident()] = uri
+            cls.deferred_refreshes[threading.get_ident()] = refreshes
+            try:
+                names = cls.cached_query(kind, query, fetch, prefix)
+            except BaseException:
+                # e.g. ViciConnectError if charon is not reachable
+                cls.partial = True
+            finally:
+                cls.drop_session()
+                cls.thread_uris.pop(threading.get_ident(), None)
+                cls.deferred_refreshes.pop(threading.get_ident(), None)
+                results.put((names, refreshes))
+
+        workers = []
+        for uri in uris:
+            for kind, query, fetch in queries:
+                workers.append(threading.Thread(target=worker, args=(uri, kind, query, fetch),
+                                                daemon=True))
+                workers[-1].start()
+        names = []
+        refreshes = []
+        for _ in workers:
+            worker_names, worker_refreshes = results.get()
+            names.extend(worker_names)
+            refreshes.extend(worker_refreshes)
+        for thread in workers:
+            thread.join()
+        for path, fetch, uri in refreshes:
+            cls.refresh_in_background(path, fetch, uri)
+        return cls.match_prefix(names, prefix)
+
+    @classmethod
+    def match_prefix(cls, names, prefix):
+        """
+        Return the unique names that start with prefix in the order of names,
+        but at most max_candidates() of them. Sets truncated if there are
+        more, names may be a generator which is not consumed any further then.
+        """
+        limit = cls.max_candidates()
+        matches = {}
+        for name in names:
+            if name.startswith(prefix or "") and name not in matches:
+                if len(matches) == limit:
+                    cls.truncated = True
+                    break
+                matches[name] = None
+        return list(matches)
+
+    @classmethod
+    def max_candidates(cls):
+        """
+        Return the maximum number of candidates to show, configured via
+        SWANCTL_COMPLETION_MAX_CANDIDATES, or None if there is no limit (0)
+        """
+        import os
+        try:
+            limit = int(os.environ.get("SWANCTL_COMPLETION_MAX_CANDIDATES",
+                                       cls.default_max_candidates))
+        except ValueError:
+            limit = cls.default_max_candidates
+        return limit if limit > 0 else None
+
+    @classmethod
+    def lookup(cls, kind, prefix):
+        """
+        Return the names of the given kind in lookups that start with prefix.
+        They are read from swanctl.conf if it has them, otherwise from the
+        cached response of the single VICI command for them, which is shared
+        by all commands completing them.
+        """
+        conf_path, command, path = cls.lookups[kind]
+        names = cls.conf_names(conf_path)
+        if names is not None:
+            return cls.match_prefix(names, prefix)
+
+        def fetch():
+            response = cls.get_session().request(command)
+            for names, value in vici_extract(response, [path]):
+                # a section per name or a list of names
+                yield names[-1] if value is None else to_str(value)
+        return cls.gather([(kind, [command], fetch)], prefix)
+
+    @classmethod
+    def sa_filters(cls, ike=None, ike_id=None):
+        """
+        Return the filters for a list-sas request.
+        noblock avoids waiting for IKE_SAs that are currently in use.
+        """
+        filters = {"noblock": "yes"}
+        if ike:
+            filters["ike"] = ike
+        if ike_id:
+            filters["ike-id"] = ike_id
+        return filters
+
+    @classmethod
+    def extract(cls, command, event, message, paths):
+        """
+        Send a streamed VICI request and yield the (names, value) tuples of
+        vici_extract for the given paths of every message in the response
+        """
+        session = cls.get_session()
+        for payload in cls.stream(session.streamed_request(command, event, message)):
+            yield from vici_extract(payload, paths)
+
+    @classmethod
+    def fetch_child_configs(cls, ike=None):
+        """
+        Yield the CHILD_SA config names, only those of the connection
+        ike if given
+        """
+        filters = {"ike": ike} if ike else None
+        for names, _ in cls.extract("list-conns", "list-conn", filters,
+                                    [("*", "children", "*")]):
+            yield names[2]
+
+    @classmethod
+    def fetch_cert_subjects(cls, filters):
+        """
+        Yield the subjects of the certificates listed by list-certs with the
+        given filters. Of every streamed certificate only its type, subject
+        and data are extracted, and of the DER encoded data only the subject
+        (the issuer of CRLs) is parsed.
+        """
+        session = cls.get_session()
+        paths = [("type",), ("subject",), ("data",)]
+        for payload in cls.stream(session.streamed_request("list-certs", "list-cert", filters)):
+            cert = {names[0]: value for names, value in vici_extract(payload, paths)}
+            if "subject" in cert:
+                # trusted public keys
+                yield to_str(cert["subject"])
+            elif cert.get("type") in (b"X509", b"X509_CRL") and "data" in cert:
+                subject = der_subject(cert["data"], cert["type"] == b"X509_CRL")
+                if subject:
+                    yield subject
+
+    @classmethod
+    def cred_fingerprint(cls):
+        """
+        Return a cheap fingerprint of the certificates loaded into charon:
+        when it was started and the mtimes of the credential directories of
+        swanctl, which change when certificates to load are added or removed.
+        """
+        import os
+        try:
+            response = cls.get_session().request("stats")
+            since = [to_str(value) for _, value in vici_extract(response, [("uptime", "since")])]
+        except ViciError:
+            # the TTL has to do
+            since = None
+        swanctl_dir = os.environ.get("SWANCTL_DIR") or os.path.dirname(cls.default_conf)
+        mtimes = []
+        for cred_dir in cls.cred_dirs:
+            try:
+                mtimes.append(os.stat(os.path.join(swanctl_dir, cred_dir)).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return [since, mtimes]
+
+    @classmethod
+    def conf_path(cls):
+        """
+        Return the path of swanctl.conf: SWANCTL_COMPLETION_CONF, or
+        swanctl.conf in SWANCTL_DIR like swanctl does, or the default.
+        Returns None if SWANCTL_COMPLETION_CONF is set but empty.
+        """
+        import os
+        path = os.environ.get("SWANCTL_COMPLETION_CONF")
+        if path is not None:
+            return path or None
+        if os.environ.get("SWANCTL_DIR"):
+            return os.path.join(os.environ["SWANCTL_DIR"], "swanctl.conf")
+        return cls.default_conf
+
+    @classmethod
+    def conf_sections(cls):
+        """
+        Return the paths of all sections in swanctl.conf and the files it
+        includes, as tuples of section names, or None if it can not be read.
+        The parsed sections of every file are cached with its mtime and size,
+        and the files matching an include pattern with the mtime of their
+        directory, so only files that changed are parsed again.
+        """
+        import marshal
+        import os
+        import time
+        begin = time.monotonic()
+        root = cls.conf_path()
+        if not root:
+            return None
+        cache_file = os.path.join(cls.cache_dir(), "swanctl-conf")
+        if cls.cache_shared():
+            # the sections of files other users may not be able to read
+            cache_file += ".%d" % os.getuid()
+        # marshal instead of json, which takes longer to import than a
+        # completion with a valid cache takes
+        try:
+            with open(cache_file, "rb") as cache:
+                cached = marshal.load(cache)
+            cached_files, cached_globs = cached["files"], cached["globs"]
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            cached, cached_files, cached_globs = None, {}, {}
+        files = {}
+        globs = {}
+        sections = []
+
+        def expand(pattern):
+            if not any(char in pattern for char in "*?["):
+                return [pattern]
+            directory = os.path.dirname(pattern)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime = None
+            entry = cached_globs.get(pattern)
+            if mtime is not None and entry is not None and entry[0] == mtime:
+                matches = entry[1]
+            else:
+                # glob imports re, only pay for it if the directory changed
+                import glob
+                matches = sorted(glob.glob(pattern))
+            if mtime is not None:
+                globs[pattern] = (mtime, matches)
+            return matches
+
+        def read(path, prefix, depth):
+            try:
+                stat = os.stat(path)
+                entry = cached_files.get(path)
+                if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                    with open(path, "r", encoding="utf-8", errors="replace") as conf_file:
+                        entry = (stat.st_mtime_ns, stat.st_size) + conf_parse(conf_file.read())
+            except OSError:
+                return False
+            files[path] = entry
+            sections.extend(prefix + section for section in entry[2])
+            if depth >= cls.conf_include_depth:
+                return True
+            for include_prefix, pattern in entry[3]:
+                # relative includes are relative to the including file
+                for included in expand(os.path.join(os.path.dirname(path), pattern)):
+                    read(included, prefix + include_prefix, depth + 1)
+            return True
+
+        if not read(os.path.abspath(root), (), 0):
+            return None
+        # the cache is shared by all swanctl.conf files, keep the others
+        updated = {"files": dict(cached_files, **files), "globs": dict(cached_globs, **globs)}
+        if updated != cached:
+            tmp_path = "%s.%d" % (cache_file, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+                with open(tmp_path, "wb") as cache:
+                    marshal.dump(updated, cache)
+                os.replace(tmp_path, cache_file)
+            except OSError:
+                pass
+            cls.trace_cache("conf", "miss", begin)
+        else:
+            cls.trace_cache("conf", "hit", begin)
+        return sections
 
     @classmethod
-    def check_opts(cls, group1, group2):
+    def conf_names(cls, path):
         """
-        Return True if any member of group1 is in group2.
-        Otherwise returns False
+        Return the names of the sections in swanctl.conf that match path
+        (see vici_path_matches), e.g. ("connections", "*") for the connection
+        names. Returns None if there are none or swanctl.conf should not be
+        used, which is the case when completing for other charon instances
+        than the local one.
         """
-        for item1 in group1:
-            for item2 in group2:
-                if item1 == item2:
-                    return True
-        return False
+        if cls.uris or len(cls.vici_uris()) != 1:
+            return None
+        sections = cls.conf_sections()
+        if sections is None:
+            return None
+        names = [section[-1] for section in sections if vici_path_matches(path, section)]
+        return names or None
 
     @classmethod
-    def switch_on_command(cls, args):
+    def complete(cls, words, cword, cur, prev, prefetch=False):
         """
-        Handle the different commands
+        Complete the word at index cword of the command line and return a
+        Result. words is a list of words or the command line as passed by
+        the completion script, cur is the word being completed and prev the
+        one before it. Nothing is printed, so it can be called for many
+        completions in one process.
+        With prefetch, completing the options of a command forks a detached
+        process that fills the cache with the values they take (see
+        prefetch), which only suits the one-shot script.
         """
         # available environment variables regarding completion
         # are cur prev words and cword
@@ -167,444 +1973,1143 @@ class SwanctlAutoComplete():
         # prev: previous word
         # words: bash array of all words
         # cword: count of words
+        cls.start_deadline()
+        cls.partial = False
+        cls.truncated = False
+        cls.uris = None
 
-        def get_session():
-            # print " " and exit if no vici gem exists
-            global HAVE_VICI_EGG
-            if HAVE_VICI_EGG:
-                try:
-                    custom_sock = None
-                    uri = os.environ.get("SWANCTL_COMPLETION_VICI_URI")
-                    if uri:
-                        parse_result = urllib.parse.urlsplit(uri)
-                        if parse_result.scheme == "unix":
-                            path = parse_result.path
-                            custom_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                            custom_sock.connect(path)
-                        elif parse_result.scheme == "tcp":
-                            host = parse_result.hostname
-                            port = parse_result.port
-                            custom_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            custom_sock.connect((host, port))
-                        else:
-                            eprint("Unsupported URL scheme %s" % parse_result.scheme)
-                            print(" ")
-                            sys.exit(1)
-                    return vici.session.Session(sock=custom_sock)
-                except:
-                    pass
-            print(" ")
-            sys.exit(0)
-
-
-        def ike_sa_config_handler(words, filtered_opts):
+        def ike_sa_config_handler(given):
             """
             Handler to present possible IKE_SA config names to the user
             """
-            possible_names = []
-            session = get_session()
-            for item in session.list_conns():
-                possible_names.extend(item.keys())
-            print(" ".join(possible_names))
-            sys.exit(0)
+            return Result(cls.lookup("conns", cur))
 
-        def ike_sa_name_handler(words, filtered_opts):
+        def ike_sa_name_handler(given):
             """
             Handler to present possible IKE_SA names to the user
             """
-            # get all known config IKE SA names, then add all known conn IKE SA names
-            possible_names = []
-            session = get_session()
-            for item in session.list_sas():
-                possible_names.extend(item.keys())
-            print(" ".join(possible_names))
+            ike_id = given.get("--ike-id")
+            index = cls.get_sa_index()
+            if index is not None:
+                return Result(cls.match_prefix(index.ike_names(ike_id, cur), cur))
 
-            sys.exit(0)
+            def fetch():
+                filters = cls.sa_filters(ike_id=ike_id)
+                for names, _ in cls.extract("list-sas", "list-sa", filters, [("*",)]):
+                    yield names[0]
+            return Result(cls.gather([("sas", cls.sa_query("ike_sa_name", given), fetch)], cur))
 
-        def child_sa_config_handler(words, filtered_opts):
+        def child_sa_config_handler(given):
             """
             Handler to present possible CHILD_SA config names to the user
             """
-            possible_names = []
-            session = get_session()
-            parser = argparse.ArgumentParser()
-            parser.add_argument("-i", "--ike", nargs="?")
-            known_args, _ = parser.parse_known_args(words)
-
-            if known_args.ike:
-                for item in session.list_conns({"ike" : str(known_args.ike)}):
-                    for ike_sa_name, ike_sa in item.items():
-                        possible_names.extend(ike_sa["children"].keys())
-            else:
-                for ike_sas in session.list_conns():
-                    for ike_sa_name, ike_sa in ike_sas.items():
-                        possible_names.extend(ike_sa["children"])
-            print(" ".join(possible_names))
-            sys.exit(0)
+            ike = given.get("--ike")
+            names = cls.conf_names(("connections", ike or "*", "children", "*"))
+            if names is not None:
+                return Result(cls.match_prefix(names, cur))
+
+            def fetch():
+                return cls.fetch_child_configs(ike)
 
+            query = ["list-conns", {"ike": ike}, "children"]
+            return Result(cls.gather([("conns", query, fetch)], cur))
 
-            # check if -i/--ike is set and if it is, use that filter
-        def child_sa_name_handler(words, filtered_opts):
+        def child_sa_name_handler(given):
             """
             Handler to present possible CHILD_SA names to the user
             """
             # check if -i, --ike, -I or --ike-id is set,
             # then get corresponding child_sa names
-            possible_names = []
-            parser = argparse.ArgumentParser()
-            parser.add_argument("-i", "--ike", nargs="?")
-            parser.add_argument("-I", "--ike-id", nargs="?")
-            known_args, _ = parser.parse_known_args(words)
-            session = get_session()
-
-            if known_args.ike:
-                for item in session.list_conns({"ike" : str(known_args.ike)}):
-                    for ike_sa_name, ike_sa in item.items():
-                        possible_names.extend(ike_sa["children"].keys())
-                for item in session.list_sas({"ike": str(known_args.ike)}):
-                    possible_names.extend(item["child-sas"].keys())
-            elif known_args.ike_id:
-                for item in session.list_sas({"ike-id" : known_args.ike_id}):
-                    for ike_sa_name, ike_sa in item.items():
-                        possible_names.extend(ike_sa["child-sas"].keys())
-            else:
-                for ike_sas in session.list_conns():
-                    for ike_sa_name, ike_sa in ike_sas.items():
-                        possible_names.extend(ike_sa["children"])
-                for ike_sas in session.list_sas():
-                    for ike_sa_name, ike_sa in ike_sas.items():
-                        possible_names.extend(ike_sa["child-sas"].keys())
-            print(" ".join(possible_names))
-            sys.exit(0)
-        def ike_id_handler(words, filtered_opts):
+            ike = given.get("--ike")
+            ike_id = given.get("--ike-id")
+
+            # configured and established names are fetched concurrently
+            queries = []
+            # a given IKE_SA ID only matches established SAs, not configs
+            if not ike_id:
+                queries.append(("conns", ["list-conns", {"ike": ike}, "children"],
+                                lambda: cls.fetch_child_configs(ike)))
+            index = cls.get_sa_index()
+            if index is None:
+                def fetch():
+                    filters = cls.sa_filters(ike=ike, ike_id=ike_id)
+                    paths = [("*", "child-sas", "*"), ("*", "child-sas", "*", "name")]
+                    for child_sa in vici_sections(
+                            cls.extract("list-sas", "list-sa", filters, paths)):
+                        # newer charon versions key CHILD_SAs by name-uniqueid
+                        yield child_sa.get("name", child_sa[None][-1])
+                queries.append(("sas", cls.sa_query("child_sa_name", given), fetch))
+            possible_names = cls.gather(queries, cur)
+            if index is not None:
+                possible_names.extend(cls.match_prefix(index.child_names(ike, ike_id, cur),
+                                                       cur))
+            return Result(cls.match_prefix(possible_names, cur))
+
+        def ike_id_handler(given):
             """
             Handler to present possible IKE_SA IDs to the user
             """
             # get all used IKE_SA IDs
-            possible_ids = []
-            session = get_session()
-            for item in session.list_sas():
-                for ike_sa_name, ike_sa in item.items():
-                    possible_ids.append(ike_sa["uniqueid"].decode("utf-8"))
+            ike = given.get("--ike")
+            index = cls.get_sa_index()
+            if index is not None:
+                return Result(cls.match_prefix(index.ike_ids(ike, cur), cur))
 
-            print(" ".join(possible_ids))
-            sys.exit(0)
-        def child_id_handler(words, filtered_opts):
+            def fetch():
+                filters = cls.sa_filters(ike=ike)
+                for _, unique_id in cls.extract("list-sas", "list-sa", filters,
+                                                [("*", "uniqueid")]):
+                    yield to_str(unique_id)
+
+            return Result(cls.gather([("sas", cls.sa_query("ike_id", given), fetch)], cur))
+
+        def child_id_handler(given):
             """
             Handler to present possible CHILD_SA IDs to the user
             """
-            possible_ids = []
-            session = get_session()
-            for item in session.list_sas():
-                for ike_sa_name, ike_sa in item.items():
-                    for child_sa_name, child_sa in ike_sa["child-sas"].items():
-                        possible_ids.append(child_sa["uniqueid"].decode("utf-8"))
-
-            print(" ".join(possible_ids))
-            sys.exit(0)
+            ike = given.get("--ike")
+            ike_id = given.get("--ike-id")
+            # list-sas can not filter by CHILD_SA name, that is done here
+            child = given.get("--child")
+            index = cls.get_sa_index()
+            if index is not None:
+                return Result(cls.match_prefix(index.child_ids(ike, ike_id, child, cur), cur))
+
+            def fetch():
+                filters = cls.sa_filters(ike=ike, ike_id=ike_id)
+                paths = [("*", "child-sas", "*"), ("*", "child-sas", "*", "name"),
+                         ("*", "child-sas", "*", "uniqueid")]
+                for child_sa in vici_sections(
+                        cls.extract("list-sas", "list-sa", filters, paths)):
+                    name = child_sa.get("name", child_sa[None][-1])
+                    if not child or name == child:
+                        yield child_sa["uniqueid"]
+
+            return Result(cls.gather([("sas", cls.sa_query("child_id", given), fetch)], cur))
 
-        def pool_handler(words, filtered_opts):
+        def pool_handler(given):
             """
             Handler to present pool names to the user
             """
-            possible_pools = []
-            session = get_session()
-            for item in session.get_pools({}):
-                possible_pools.extend(item)
-            
-            print(" ".join(possible_pools))
-            sys.exit(0)
-        def timeout_handler(words, filtered_opts):
+            return Result(cls.lookup("pools", cur))
+
+        def authority_handler(given):
             """
-            Handler to present possible timeout values to the user
+            Handler to present certification authority names to the user
             """
-            print(" ")
-            sys.exit(0)
-        def file_handler(words, filtered_opts):
+            return Result(cls.lookup("authorities", cur))
+
+        def peer_id_handler(given):
+            """
+            Handler to present the remote identities of the IKE_SAs to the user
+            """
+            ike = given.get("--ike")
+            ike_id = given.get("--ike-id")
+
+            def fetch():
+                filters = cls.sa_filters(ike=ike, ike_id=ike_id)
+                for _, remote_id in cls.extract("list-sas", "list-sa", filters,
+                                                [("*", "remote-id")]):
+                    yield to_str(remote_id)
+
+            return Result(cls.gather([("sas", cls.sa_query("peer_id", given), fetch)], cur))
+
+        def cert_subject_handler(given):
+            """
+            Handler to present the subjects of the loaded certificates to the user
+            """
+            # swanctl passes --type and --flag to charon in upper case
+            filters = {key: given[option].upper() for key, option in
+                       (("type", "--type"), ("flag", "--flag")) if given.get(option)}
+
+            def fetch():
+                return cls.fetch_cert_subjects(filters)
+
+            def query():
+                return ["list-certs", filters, "subject", cls.cred_fingerprint()]
+            return Result(cls.gather([("certs", query, fetch)], cur))
+
+        def file_handler(given):
             """
             Handler to present possible valid files to the user
             """
-            # returnstatus 4 is handled by the shell script as prompt to
-            # run _filedir
-            print(" ")
-            sys.exit(4)
-        def url_handler(words, filtered_opts):
+            # the completion script runs _filedir
+            return Result(action="filedir")
+        def url_handler(given):
             """
             Handler to present possible valid URLs to the user
             """
-            print(" ")
-            # returnstatus 5 is handled by the shell script as prompt to
-            # run _known_hosts_real or other handler to get known hosts
-            sys.exit(5)
+            # the completion script runs _known_hosts_real or other handler
+            # to get known hosts
+            return Result(action="hosts")
 
-        words = shlex.split(str(args.words))
+        handlers = {
+            "ike_sa_config": ike_sa_config_handler,
+            "ike_sa_name": ike_sa_name_handler,
+            "child_sa_config": child_sa_config_handler,
+            "child_sa_name": child_sa_name_handler,
+            "ike_id": ike_id_handler,
+            "child_id": child_id_handler,
+            "pool": pool_handler,
+            "authority": authority_handler,
+            "peer_id": peer_id_handler,
+            "cert_subject": cert_subject_handler,
+            "file": file_handler,
+            "url": url_handler,
+        }
 
-        cur = args.cur
-        prev = args.prev
-
-        cword = int(args.cword, 10)
-        general_opts = [("-h", "--help"), ("-r", "--raw"), ("-P", "--pretty"),
-                        ("-v", "--debug"), ("-+", "--options"), ("-u", "--uri")]
+        if isinstance(words, str):
+            words = cls.split_words(words)
+        cword = int(cword)
 
         # cword can not be 0 if called correctly, so no reason to check it
         if cword == 1:
-            # only binary name "swanctl" given, print out all possible commands
-            print(str.join(" ", cls.long_commands + cls.short_commands))
-            sys.exit(0)
+            # only binary name "swanctl" given, offer all possible commands
+            cls.trace_handler("commands")
+            return Result(cls.match_prefix(cls.long_commands + cls.short_commands, cur),
+                          filtered=True, reusable=True)
 
-        command = words[1]
-        # if we only have the command, we set cur to "" to avoid presenting
-        # valid suggestions for options of that command that have the same
-        # name as the command and we also remove the first two words
-        # to avoid removing them from the list of suggestions
-        # deal with general opts
-
-        if cword == 2:
-            prev = ""
-            # This is very hacky and should probably be handled differently
-            # (e.g. slicing the array before passed into filter_opts)
-            words[0] = ""
-            words[1] = ""
-        general_opts = cls.filter_opts(words, general_opts)
+        spec = cls.compile_grammar().get(words[1])
+        if spec is None:
+            # no matching command
+            cls.trace_handler("unknown")
+            return Result()
+        used, given = cls.scan_words(spec, words, cword)
+        # complete for the charon the command line is about
+        cls.uris = [given["--uri"]] if given.get("--uri") else None
         # no suggestions if help message is asked
-        if cls.check_opts((prev, cur), ("-h", "--help")):
-            sys.exit(0)
-        if cls.check_opts((prev, cur), ("-u", "--uri")):
-            url_handler(words, general_opts)
-        if cls.check_opts((prev, cur), ("--options", "-+")):
-            file_handler(words, general_opts)
-        if cls.check_opts((prev, cur), ("-v", "--debug")):
-            print("-1 0 1 2 3 4")
-            sys.exit(0)
+        if "--help" in used:
+            cls.trace_handler("help")
+            return Result()
+
+        # complete the value of the previous option, prev is the command
+        # itself if we only have the command
+        opt_long = spec["options"].get(prev) if cword > 2 else None
+        if opt_long in spec["values"]:
+            value = spec["values"][opt_long]
+            cls.trace_handler(value if isinstance(value, str) else opt_long)
+            if isinstance(value, str):
+                try:
+                    result = handlers[value](given)
+                except (ViciConnectError, ViciError, OSError):
+                    # charon is not reachable or does not know the command
+                    cls.drop_session()
+                    return Result()
+                result.truncated = cls.truncated
+                # the names are filtered by cur, which is fine for a growing cur
+                result.filtered = result.action == "none"
+                result.reusable = result.filtered and not cls.partial and not cls.truncated
+                return result
+            if value is not None:
+                return Result(cls.match_prefix(value, cur), filtered=True, reusable=True)
+            return Result()
+
+        cls.trace_handler("options")
+        excluded = set(used)
+        for opt_long in used:
+            excluded.update(spec["excludes"].get(opt_long, ()))
+        result = Result(cls.match_prefix([opt for opt, opt_long in spec["order"]
+                                          if opt_long not in excluded], cur),
+                        filtered=True, reusable=True)
+        if not prefetch:
+            return result
+        cls.prefetch({value: handlers[value] for opt_long, value in spec["values"].items()
+                      if opt_long not in excluded and value in cls.prefetch_handlers}, given)
+        return result
+
+    @classmethod
+    def split_words(cls, words):
+        """
+        Split the command line as passed by the completion script into words
+        """
+        # only pay for importing shlex if there are quotes or escapes
+        # (\x27 is a single quote, which can not be used in this script)
+        if any(char in words for char in "\"\x27\\"):
+            import shlex
+            try:
+                return shlex.split(words)
+            except ValueError:
+                # the current word may still lack its closing quote
+                pass
+        return words.split()
+
+class ViciError(Exception):
+    """
+    Raised if charon does not know a command or event
+    """
+
+
+class ViciConnectError(Exception):
+    """
+    Raised if the VICI socket can not be connected
+    """
+
+
+class ViciSession():
+    """
+    Minimal client for the VICI protocol of charon. Received messages are
+    returned as memoryviews of the packets, so callers can pick the few
+    values they need with vici_extract instead of decoding everything.
+    """
+    # packet types
+    CMD_REQUEST = 0
+    CMD_RESPONSE = 1
+    CMD_UNKNOWN = 2
+    EVENT_REGISTER = 3
+    EVENT_UNREGISTER = 4
+    EVENT_CONFIRM = 5
+    EVENT_UNKNOWN = 6
+    EVENT = 7
 
-        if command in ("--counters", "-C"):
-            opts = [("-n", "--name"), ("-a", "--all"), ("-R", "--reset")]
-            filtered_opts = cls.filter_opts_conflicting(
-                words, opts, [(("-n", "--name"), ("-a", "--all"))])
-
-            if cls.check_opts((prev, cur), ("-n", "--name")):
-                ike_sa_name_handler(words, filtered_opts)
-            print(" ".join(itertools.chain(filtered_opts.keys(),
-                                           general_opts)))
-        elif command in ("--initiate", "-i"):
-            opts = [("-c", "--child"), ("-i", "--ike")]
-            filtered_opts = cls.filter_opts(words, opts)
-            if cls.check_opts((prev, cur), ("-c", "--child")):
-                child_sa_config_handler(words, filtered_opts)
-            if cls.check_opts((prev, cur), ("-i", "--ike")):
-                ike_sa_config_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-t", "--terminate"):
-            opts = [("-c", "--child"), ("-i", "--ike"), ("-C", "--child-id"),
-                    ("-I", "--ike-id"), ("-f", "--force"), ("-t", "--timeout")]
-            filtered_opts = cls.filter_opts_conflicting(
-                words, opts, [(("-C", "--child-id"), ("-I", "--ike-id"),
-                               ("-c", "--child"), ("-i", "--ike"))])
-
-            # deal with child_sa name
-            if cls.check_opts((prev, opts), ("-c", "--child")):
-                child_sa_name_handler(words, filtered_opts)
-            # deal with ike_sa name
-            if cls.check_opts((prev, opts), ("-i", "--ike")):
-                ike_sa_name_handler(words, filtered_opts)
-            # deal with child IDs
-            if cls.check_opts((prev, opts), ("-C", "--child-id")):
-                child_id_handler(words, filtered_opts)
-            # deal with ike_sa IDs
-            if cls.check_opts((prev, opts), ("-I", "--ike-id")):
-                ike_id_handler(words, filtered_opts)
-            if cls.check_opts((prev, opts), ("-t", "--timeout")):
-                timeout_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-R", "--rekey"):
-            opts = [("-c", "--child"), ("-i", "--ike"), ("-C", "--child-id"),
-                    ("-I", "--ike-id"), ("-a", "--reauth")]
-            filtered_opts = cls.filter_opts_conflicting(
-                words, opts, [(("-C", "--child-id"), ("-I", "--ike-id"))])
-
-            # deal with child_sa name
-            if cls.check_opts((prev, opts), ("-c", "--child")):
-                sys.exit(0)
-            # deal with ike_sa name
-            if cls.check_opts((prev, opts), ("-i", "--ike")):
-                ike_sa_name_handler(words, filtered_opts)
-            # deal with child IDs
-            if cls.check_opts((prev, opts), ("-C", "--child-id")):
-                child_id_handler(words, filtered_opts)
-            # deal with ike_sa IDs
-            if cls.check_opts((prev, opts), ("-I", "--ike-id")):
-                ike_id_handler(words, filtered_opts)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-d", "--redirect"):
-            opts = [("-i", "--ike"), ("-I", "--ike-id"), ("p", "--peer-id"),
-                    ("-g", "--gateway")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            # deal with child_sa name
-            if cls.check_opts((prev, opts), ("-c", "--child")):
-                child_sa_name_handler(words, filtered_opts)
-            # deal with ike_sa name
-            if cls.check_opts((prev, opts), ("-i", "--ike")):
-                ike_sa_name_handler(words, filtered_opts)
-            # deal with child IDs
-            if cls.check_opts((prev, opts), ("-C", "--child-id")):
-                child_id_handler(words, filtered_opts)
-            # deal with ike_sa IDs
-            if cls.check_opts((prev, opts), ("-I", "--ike-id")):
-                ike_id_handler(words, filtered_opts)
-
-            if cls.check_opts((prev, opts), ("-p", "--peer-id", "-g", "--gateway")):
-                sys.exit(0)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-
-        elif command in ("-u", "--uninstall", "-p", "--install"):
-            opts = [("-i", "--ike"), ("-c", "--child")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-i", "--ike")):
-                ike_sa_name_handler(words, filtered_opts)
-            if cls.check_opts((prev, opts), ("-c", "--child")):
-                child_sa_name_handler(words, filtered_opts)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-l", "--list-sas"):
-            opts = [("-i", "--ike"), ("-I", "--ike-id")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-i", "--ike")):
-                ike_sa_name_handler(words, filtered_opts)
-            if cls.check_opts((prev, opts), ("-I", "--ike-id")):
-                ike_id_handler(words, filtered_opts)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-P", "--list-pols"):
-            opts = [("-c", "--child"), ("-t", "--trap"), ("-d", "--drop"),
-                    ("-p", "--pass")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-c", "--child")):
-                child_sa_name_handler(words, filtered_opts)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-B", "--list-authorities"):
-            opts = [("-n", "--name")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-n", "--name")):
-                sys.exit(0)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-x", "--list-certs"):
-            opts = [("-s", "--subject"), ("-t", "--type"), ("-f", "--flag"),
-                    ("-p", "--pem"), ("-S", "--short"), ("-U", "--utc")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-s", "--subject")):
-                sys.exit(0)
-            if cls.check_opts((prev, opts), ("-t", "--type")):
-                print("x509 x509_ac x509_crl ocsp_response pubkey")
-                sys.exit(0)
-            if cls.check_opts((prev, opts), ("-f", "--flag")):
-                print("none ca aa ocsp any")
-                sys.exit(0)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-A", "--list-pools"):
-            opts = [("-l", "--leases"), ("-n", "--name"), ("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-n", "--name")):
-                # handle pool name
-                pool_handler(words, filtered_opts)
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-f", "--flush-certs"):
-            opts = [("-t", "--type")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-t", "--type")):
-                print("x509 x509_ac x509_crl ocsp_response pubkey")
-                sys.exit(0)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-q", "--load-all"):
-            opts = [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-b", "--load-authorities"):
-            opts = [("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-c", "--load-conns"):
-            opts = [("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-s", "--load-creds"):
-            opts = [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-a", "--load-pools"):
-            opts = [("-c", "--clear"), ("-n", "--noprompt"), ("-f", "--file")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            if cls.check_opts((prev, opts), ("-f", "--file")):
-                file_handler(words, filtered_opts)
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
-        elif command in ("-v", "--version"):
-            opts = [("-d", "--daemon")]
-            filtered_opts = cls.filter_opts(words, opts)
-
-            print(str.join(" ", itertools.chain(filtered_opts.keys(),
-                                                general_opts)))
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, packet_type, name=None, message=b""):
+        """
+        Send a packet, name is required for requests and event (un)registrations
+        """
+        packet = bytearray([packet_type])
+        if name is not None:
+            name = name.encode("utf-8")
+            packet.append(len(name))
+            packet += name
+        packet += message
+        self.sock.sendall(len(packet).to_bytes(4, "big") + packet)
+
+    def receive(self):
+        """
+        Receive a packet and return its type, name (or None) and message
+        """
+        length = int.from_bytes(self.receive_exactly(4), "big")
+        packet = self.receive_exactly(length)
+        packet_type = packet[0]
+        if packet_type in (self.CMD_REQUEST, self.EVENT_REGISTER,
+                           self.EVENT_UNREGISTER, self.EVENT):
+            name_end = 2 + packet[1]
+            return packet_type, bytes(packet[2:name_end]).decode("utf-8"), packet[name_end:]
+        return packet_type, None, packet[1:]
+
+    def receive_exactly(self, length):
+        """
+        Receive length bytes into a new buffer and return a memoryview of it
+        """
+        view = memoryview(bytearray(length))
+        received = 0
+        while received < length:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("VICI socket closed")
+            received += count
+        return view
+
+    def request(self, command, message=None):
+        """
+        Send a command and return its response message
+        """
+        self.send(self.CMD_REQUEST, command, vici_encode(message or {}))
+        packet_type, _, response = self.receive()
+        if packet_type != self.CMD_RESPONSE:
+            raise ViciError("unknown command %s" % command)
+        return response
+
+    def register(self, event, register=True):
+        """
+        Register for (or unregister from) an event
+        """
+        self.send(self.EVENT_REGISTER if register else self.EVENT_UNREGISTER, event)
+        packet_type, _, _ = self.receive()
+        if packet_type != self.EVENT_CONFIRM:
+            raise ViciError("unknown event %s" % event)
+
+    def streamed_request(self, command, event, message=None):
+        """
+        Send a command whose response is streamed as events and yield the
+        message of each event
+        """
+        self.register(event)
+        self.send(self.CMD_REQUEST, command, vici_encode(message or {}))
+        try:
+            while True:
+                packet_type, name, payload = self.receive()
+                if packet_type == self.EVENT and name == event:
+                    yield payload
+                elif packet_type == self.CMD_RESPONSE:
+                    break
+                elif packet_type == self.CMD_UNKNOWN:
+                    raise ViciError("unknown command %s" % command)
+        except GeneratorExit:
+            # the rest of the response is still in the socket
+            self.sock.close()
+            raise
+        self.register(event, False)
+
+    def listen(self):
+        """
+        Yield the name and message of the events registered for
+        """
+        while True:
+            packet_type, name, payload = self.receive()
+            if packet_type == self.EVENT:
+                yield name, payload
+
+
+# VICI message element types
+SECTION_START = 1
+SECTION_END = 2
+KEY_VALUE = 3
+LIST_START = 4
+LIST_ITEM = 5
+LIST_END = 6
+
+
+def vici_encode(message):
+    """
+    Encode a dict as VICI message. Values may be str, bytes, lists of
+    those or dicts for sub-sections.
+    """
+    def encode_value(value):
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        return len(value).to_bytes(2, "big") + value
+
+    encoded = bytearray()
+    for key, value in message.items():
+        key = key.encode("utf-8")
+        if isinstance(value, dict):
+            encoded += bytes([SECTION_START, len(key)]) + key
+            encoded += vici_encode(value)
+            encoded.append(SECTION_END)
+        elif isinstance(value, (list, tuple)):
+            encoded += bytes([LIST_START, len(key)]) + key
+            for item in value:
+                encoded.append(LIST_ITEM)
+                encoded += encode_value(item)
+            encoded.append(LIST_END)
         else:
-            # no matching command, exit
-            print()
-            sys.exit(0)
+            encoded += bytes([KEY_VALUE, len(key)]) + key
+            encoded += encode_value(value)
+    return bytes(encoded)
+
+
+def vici_decode(payload):
+    """
+    Decode a whole VICI message into nested dicts. Values are bytes, lists
+    are lists of bytes. Only used for small messages like events.
+    """
+    message = {}
+    stack = [message]
+    position = 0
+    while position < len(payload):
+        element = payload[position]
+        position += 1
+        if element in (SECTION_START, KEY_VALUE, LIST_START):
+            name_end = position + 1 + payload[position]
+            name = bytes(payload[position + 1:name_end]).decode("utf-8")
+            position = name_end
+        if element in (KEY_VALUE, LIST_ITEM):
+            value_end = position + 2 + int.from_bytes(payload[position:position + 2], "big")
+            value = bytes(payload[position + 2:value_end])
+            position = value_end
+        if element == SECTION_START:
+            stack[-1][name] = {}
+            stack.append(stack[-1][name])
+        elif element == KEY_VALUE:
+            stack[-1][name] = value
+        elif element == LIST_START:
+            stack[-1][name] = []
+            stack.append(stack[-1][name])
+        elif element == LIST_ITEM:
+            stack[-1].append(value)
+        elif element in (SECTION_END, LIST_END):
+            stack.pop()
+    return message
+
+
+def vici_path_matches(path, names):
+    """
+    Return True if the names match the path, "*" matches any name
+    """
+    return len(path) == len(names) and all(
+        part in ("*", name) for part, name in zip(path, names))
+
+
+def vici_extract(payload, paths):
+    """
+    Walk the VICI message in payload (a memoryview) and yield (names, value)
+    for every element whose path matches one of paths. A path is a tuple of
+    section, key or list names in which "*" matches any name, e.g.
+    ("*", "child-sas", "*", "uniqueid"). names holds the actual names along
+    the path, value is the bytes of a key or list item or None for a section.
+    Sections and lists that are not on any of the paths are skipped without
+    decoding anything in them.
+    """
+    stack = []
+    # depth of nested sections/lists within a skipped one
+    skip = 0
+    position = 0
+    end = len(payload)
+    while position < end:
+        element = payload[position]
+        position += 1
+        if element in (SECTION_START, KEY_VALUE, LIST_START):
+            name_end = position + 1 + payload[position]
+            if not skip:
+                names = tuple(stack) + (
+                    bytes(payload[position + 1:name_end]).decode("utf-8"),)
+            position = name_end
+        if element in (KEY_VALUE, LIST_ITEM):
+            value_end = position + 2 + int.from_bytes(payload[position:position + 2], "big")
+            if not skip:
+                if element == LIST_ITEM:
+                    names = tuple(stack)
+                if any(vici_path_matches(path, names) for path in paths):
+                    yield names, bytes(payload[position + 2:value_end])
+            position = value_end
+        elif element in (SECTION_START, LIST_START):
+            if skip:
+                skip += 1
+                continue
+            if element == SECTION_START:
+                if any(vici_path_matches(path, names) for path in paths):
+                    yield names, None
+                # descend only if a longer path continues below this section
+                descend = any(len(path) > len(names) and
+                              vici_path_matches(path[:len(names)], names)
+                              for path in paths)
+            else:
+                descend = any(vici_path_matches(path, names) for path in paths)
+            if descend:
+                stack.append(names[-1])
+            else:
+                skip = 1
+        elif element in (SECTION_END, LIST_END):
+            if skip:
+                skip -= 1
+            else:
+                stack.pop()
+
+
+def vici_sections(items):
+    """
+    Group the (names, value) tuples of vici_extract by section: every
+    section on the paths starts a new dict, which holds the names of the
+    section under None and the decoded values of the following keys.
+    """
+    section = None
+    for names, value in items:
+        if value is None:
+            if section is not None:
+                yield section
+            section = {None: names}
+        elif section is not None and names[:-1] == section[None]:
+            section[names[-1]] = to_str(value)
+    if section is not None:
+        yield section
+
+
+# short names of relative distinguished names, by OID, as printed by strongSwan
+DN_NAMES = {
+    "2.5.4.3": "CN", "2.5.4.4": "S", "2.5.4.5": "SN", "2.5.4.6": "C",
+    "2.5.4.7": "L", "2.5.4.8": "ST", "2.5.4.10": "O", "2.5.4.11": "OU",
+    "2.5.4.12": "T", "2.5.4.13": "D", "2.5.4.41": "N", "2.5.4.42": "G",
+    "2.5.4.43": "I", "2.5.4.46": "dnQualifier", "2.5.4.65": "pseudonym",
+    "1.2.840.113549.1.9.1": "E", "1.2.840.113549.1.9.2": "UN",
+    "0.9.2342.19200300.100.1.1": "UID", "0.9.2342.19200300.100.1.25": "DC",
+}
+
+
+def der_element(data, position):
+    """
+    Return the tag of the DER element at position and the start and end of
+    its contents
+    """
+    tag = data[position]
+    length = data[position + 1]
+    position += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = int.from_bytes(data[position:position + count], "big")
+        position += count
+    if position + length > len(data):
+        raise ValueError("truncated DER element")
+    return tag, position, position + length
+
+
+def der_subject(data, crl=False):
+    """
+    Return the subject DN of a DER encoded X.509 certificate, or the issuer
+    of a CRL, e.g. "C=CH,O=strongSwan,CN=moon". Only the elements in front
+    of it are walked without decoding them. Returns None if data can not be
+    parsed.
+    """
+    # elements in front of the name as (tag, optional): version, serial,
+    # signature, issuer and validity of certificates, version and signature
+    # of CRLs
+    if crl:
+        skip = ((0x02, True), (0x30, False))
+    else:
+        skip = ((0xa0, True), (0x02, False), (0x30, False), (0x30, False), (0x30, False))
+    try:
+        _, position, _ = der_element(data, 0)
+        _, position, _ = der_element(data, position)
+        for expected, optional in skip:
+            tag, _, end = der_element(data, position)
+            if tag == expected:
+                position = end
+            elif not optional:
+                return None
+        tag, position, end = der_element(data, position)
+        if tag != 0x30:
+            return None
+        rdns = []
+        while position < end:
+            _, rdn_position, position = der_element(data, position)
+            _, attr_position, _ = der_element(data, rdn_position)
+            _, oid_start, oid_end = der_element(data, attr_position)
+            tag, value_start, value_end = der_element(data, oid_end)
+            oid = der_oid(data[oid_start:oid_end])
+            rdns.append("%s=%s" % (DN_NAMES.get(oid, oid),
+                                   der_string(tag, data[value_start:value_end])))
+        return ",".join(rdns)
+    except (IndexError, ValueError):
+        return None
+
+
+def der_oid(data):
+    """
+    Return the dotted form of a DER encoded OID
+    """
+    values = []
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            values.append(value)
+            value = 0
+    # the first value encodes the first two arcs
+    first = min(values[0] // 40, 2)
+    return ".".join(map(str, [first, values[0] - 40 * first] + values[1:]))
+
+
+def der_string(tag, data):
+    """
+    Decode a DER encoded string with the given tag
+    """
+    if tag == 0x1e:
+        return data.decode("utf-16-be", "replace")
+    if tag == 0x1c:
+        return data.decode("utf-32-be", "replace")
+    if tag == 0x14:
+        return data.decode("latin-1")
+    return data.decode("utf-8", "replace")
+
+
+def conf_parse(text):
+    """
+    Parse a swanctl.conf file (strongswan.conf syntax) and return the paths
+    of its sections as tuples of section names and its include statements as
+    (section path, pattern) tuples, both relative to the top of the file.
+    Values are skipped. Sections that are opened more than once are returned
+    once for every time.
+    """
+    sections = []
+    includes = []
+    stack = []
+    # words of the current statement
+    words = []
+    position = 0
+    end = len(text)
+    while position < end:
+        char = text[position]
+        if char == "\n" or char == "#":
+            if char == "#":
+                position = text.find("\n", position)
+                if position < 0:
+                    position = end
+            if len(words) > 1 and words[0] == "include":
+                includes.append((tuple(stack), " ".join(words[1:])))
+            words = []
+            position += 1
+        elif char.isspace():
+            position += 1
+        elif char == "{":
+            # "name {" or "name : template, ... {"
+            stack.append(words[0] if words else "")
+            sections.append(tuple(stack))
+            words = []
+            position += 1
+        elif char == "}":
+            if stack:
+                stack.pop()
+            words = []
+            position += 1
+        elif char == "=":
+            # skip the value, which ends at the end of the line, a comment or
+            # the end of the section and may contain multi-line strings
+            position += 1
+            while position < end and text[position] not in "\n#}":
+                if text[position] == "\"":
+                    position = conf_string(text, position)[1]
+                else:
+                    position += 1
+            words = []
+        elif char == "\"":
+            word, position = conf_string(text, position)
+            words.append(word)
+        elif char == ":":
+            words.append(char)
+            position += 1
+        else:
+            start = position
+            while position < end and not text[position].isspace() and \
+                    text[position] not in "{}=#:\"":
+                position += 1
+            words.append(text[start:position])
+    if len(words) > 1 and words[0] == "include":
+        includes.append((tuple(stack), " ".join(words[1:])))
+    return sections, includes
+
+
+def conf_string(text, position):
+    """
+    Return the quoted string starting at position in text without quotes and
+    escapes, and the position after it
+    """
+    chars = []
+    position += 1
+    while position < len(text) and text[position] != "\"":
+        if text[position] == "\\" and position + 1 < len(text):
+            position += 1
+        chars.append(text[position])
+        position += 1
+    return "".join(chars), position + 1
+
+
+class Snapshot():
+    """
+    Compact cache file of sorted names, read via mmap so concurrent shells
+    share the page cache and lookups never parse the whole file.
+    Layout (little endian): the header (magic, version, timestamp, count),
+    a table of count uint32 record offsets and the records, each a uint16
+    length followed by the UTF-8 encoded name. Records are sorted by their
+    encoded bytes, so names with a given prefix are found by binary search.
+    """
+    magic = b"SWCS"
+    version = 1
+    header_format = "<4sBxxxdI"
+    header_size = 20
+
+    def __init__(self, path):
+        import mmap
+        import struct
+        with open(path, "rb") as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.timestamp, self.count = struct.unpack_from(
+                self.header_format, self.map)
+            if magic != self.magic or version != self.version:
+                raise ValueError("invalid snapshot %s" % path)
+            if len(self.map) < self.header_size + 4 * self.count:
+                raise ValueError("truncated snapshot %s" % path)
+        except (struct.error, ValueError):
+            self.map.close()
+            raise ValueError("invalid snapshot %s" % path)
+        self.unpack_from = struct.unpack_from
+
+    def close(self):
+        """
+        Release the mapping
+        """
+        self.map.close()
+
+    def record(self, index):
+        """
+        Return the encoded name of the record at index, raises ValueError
+        if it lies outside of the file
+        """
+        offset, = self.unpack_from("<I", self.map, self.header_size + 4 * index)
+        if offset + 2 > len(self.map):
+            raise ValueError("invalid snapshot record")
+        length, = self.unpack_from("<H", self.map, offset)
+        if offset + 2 + length > len(self.map):
+            raise ValueError("invalid snapshot record")
+        return self.map[offset + 2:offset + 2 + length]
+
+    def lookup(self, prefix="", limit=None):
+        """
+        Return the names starting with prefix, at most limit of them.
+        Raises ValueError if the snapshot is corrupt.
+        """
+        prefix = (prefix or "").encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        names = []
+        for index in range(low, self.count if limit is None else min(self.count, low + limit)):
+            name = self.record(index)
+            if not name.startswith(prefix):
+                break
+            names.append(name.decode("utf-8"))
+        return names
+
+    @classmethod
+    def write(cls, path, names, timestamp, mode=None):
+        """
+        Atomically write names as snapshot to path, private to the user
+        unless another file mode is given
+        """
+        import os
+        import struct
+        import tempfile
+        records = sorted(name for name in set(
+            name.encode("utf-8") for name in names) if len(name) <= 0xffff)
+        offsets = []
+        offset = cls.header_size + 4 * len(records)
+        for record in records:
+            offsets.append(offset)
+            offset += 2 + len(record)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as snapshot_file:
+                if mode is not None:
+                    os.fchmod(fd, mode)
+                snapshot_file.write(struct.pack(cls.header_format, cls.magic, cls.version,
+                                                timestamp, len(records)))
+                snapshot_file.write(struct.pack("<%dI" % len(records), *offsets))
+                for record in records:
+                    snapshot_file.write(struct.pack("<H", len(record)))
+                    snapshot_file.write(record)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class SaIndex():
+    """
+    Incremental index of IKE_SA and CHILD_SA names and unique IDs.
+    It is filled once by a full list-sas and then kept up to date with the
+    ike-updown, child-updown, ike-rekey and child-rekey events.
+    """
+    events = ["ike-updown", "child-updown", "ike-rekey", "child-rekey"]
+
+    def __init__(self, ike_sas=None):
+        import threading
+        # IKE_SA unique ID -> [IKE_SA name, {CHILD_SA unique ID: CHILD_SA name}]
+        self.ike_sas = ike_sas if ike_sas is not None else {}
+        self.synced = ike_sas is not None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def resync(self, session):
+        """
+        Rebuild the index from a full list-sas
+        """
+        ike_sas = {}
+        paths = [("*",), ("*", "uniqueid"), ("*", "child-sas", "*"),
+                 ("*", "child-sas", "*", "name"), ("*", "child-sas", "*", "uniqueid")]
+        for payload in session.streamed_request("list-sas", "list-sa", {"noblock": "yes"}):
+            children = None
+            for section in vici_sections(vici_extract(payload, paths)):
+                names = section[None]
+                if len(names) == 1:
+                    children = {}
+                    ike_sas[section["uniqueid"]] = [names[0], children]
+                elif children is not None:
+                    # newer charon versions key CHILD_SAs by name-uniqueid
+                    children[section["uniqueid"]] = section.get("name", names[-1])
+        with self.lock:
+            self.ike_sas = ike_sas
+            self.generation += 1
+            self.synced = True
+
+    def children(self, ike_sa):
+        """
+        Return the CHILD_SA unique IDs and names of an IKE_SA dict
+        """
+        children = {}
+        for child_sa_key, child_sa in (ike_sa.get("child-sas") or {}).items():
+            # newer charon versions key CHILD_SAs by name-uniqueid
+            children[to_str(child_sa["uniqueid"])] = to_str(
+                child_sa.get("name", child_sa_key))
+        return children
+
+    def apply_event(self, label, event):
+        """
+        Update the index with a VICI event.
+        Returns False if the event does not match the index.
+        """
+        with self.lock:
+            self.generation += 1
+            for ike_sa_name, ike_sa in event.items():
+                if label == "ike-updown":
+                    unique_id = to_str(ike_sa["uniqueid"])
+                    if ike_sa.get("up") == b"yes":
+                        self.ike_sas[unique_id] = [ike_sa_name, self.children(ike_sa)]
+                    elif self.ike_sas.pop(unique_id, None) is None:
+                        return False
+                elif label == "ike-rekey":
+                    old_id = to_str(ike_sa["old"]["uniqueid"])
+                    if self.ike_sas.pop(old_id, None) is None:
+                        return False
+                    self.ike_sas[to_str(ike_sa["new"]["uniqueid"])] = [
+                        ike_sa_name, self.children(ike_sa["new"])]
+                elif label in ("child-updown", "child-rekey"):
+                    unique_id = to_str(ike_sa["uniqueid"])
+                    if unique_id not in self.ike_sas:
+                        return False
+                    children = self.ike_sas[unique_id][1]
+                    if label == "child-updown":
+                        if ike_sa.get("up") == b"yes":
+                            children.update(self.children(ike_sa))
+                            continue
+                        removed = self.children(ike_sa)
+                        added = {}
+                    else:
+                        removed = {}
+                        added = {}
+                        for child_sa_key, child_sa in (ike_sa.get("child-sas") or {}).items():
+                            removed.update(self.children(
+                                {"child-sas": {child_sa_key: child_sa["old"]}}))
+                            added.update(self.children(
+                                {"child-sas": {child_sa_key: child_sa["new"]}}))
+                    for child_id in removed:
+                        if children.pop(child_id, None) is None:
+                            return False
+                    children.update(added)
+        return True
+
+    def select(self, ike=None, ike_id=None):
+        """
+        Return the IKE_SA unique IDs, names and children matching the filters
+        """
+        for unique_id, (ike_sa_name, children) in self.ike_sas.items():
+            if ike and ike_sa_name != ike or ike_id and unique_id != ike_id:
+                continue
+            yield unique_id, ike_sa_name, children
+
+    def ike_names(self, ike_id=None, prefix=""):
+        """
+        Return the names of all IKE_SAs, or of the one with the given ID,
+        that start with prefix
+        """
+        with self.lock:
+            return list(dict.fromkeys(
+                name for _, name, _ in self.select(ike_id=ike_id)
+                if name.startswith(prefix)))
+
+    def ike_ids(self, ike=None, prefix=""):
+        """
+        Return the unique IDs of all IKE_SAs, optionally only of those with
+        the given name, that start with prefix
+        """
+        with self.lock:
+            return [unique_id for unique_id, _, _ in self.select(ike=ike)
+                    if unique_id.startswith(prefix)]
+
+    def child_names(self, ike=None, ike_id=None, prefix=""):
+        """
+        Return the names of all CHILD_SAs, optionally only those of the IKE_SAs
+        with the given name or unique ID, that start with prefix
+        """
+        names = {}
+        with self.lock:
+            for _, _, children in self.select(ike, ike_id):
+                names.update(dict.fromkeys(name for name in children.values()
+                                           if name.startswith(prefix)))
+        return list(names)
+
+    def child_ids(self, ike=None, ike_id=None, child=None, prefix=""):
+        """
+        Return the unique IDs of all CHILD_SAs, optionally only those with
+        the given name or of the IKE_SAs with the given name or unique ID,
+        that start with prefix
+        """
+        with self.lock:
+            return [child_id for _, _, children in self.select(ike, ike_id)
+                    for child_id, name in children.items()
+                    if (not child or name == child) and child_id.startswith(prefix)]
+
+    def records(self):
+        """
+        Yield the records of the index as stored by SaIndexFile: every name
+        and ID once for each query it answers, prefixed by the key of the
+        query. The caller holds the lock.
+        """
+        key = SaIndexFile.key
+        for unique_id, (ike_sa_name, children) in self.ike_sas.items():
+            for ike_id in ("", unique_id):
+                yield key("ike-names", ike_id) + ike_sa_name
+            for ike in ("", ike_sa_name):
+                yield key("ike-ids", ike) + unique_id
+            for child_id, child_name in children.items():
+                # queries with both an IKE_SA name and ID use the ID only
+                for ike, ike_id in (("", ""), (ike_sa_name, ""), ("", unique_id)):
+                    yield key("child-names", ike, ike_id) + child_name
+                    for child in ("", child_name):
+                        yield key("child-ids", ike, ike_id, child) + child_id
+
+
+class SaIndexFile():
+    """
+    SA index as written by the watcher for other processes: a Snapshot of
+    the names and IDs of SaIndex.records, each prefixed by the key of the
+    query it answers, so a query is a prefix lookup instead of loading the
+    whole index. The key of the "pid" query holds the PID of the watcher.
+    """
+    def __init__(self, snapshot, limit=None):
+        self.snapshot = snapshot
+        self.limit = limit
+
+    @staticmethod
+    def key(query, *filters):
+        """
+        Return the key of a query with the given filters, empty if unset
+        """
+        return "\x1f".join((query,) + filters) + "\x1f"
+
+    def values(self, key, prefix=""):
+        """
+        Return the names and IDs of the query with the given key that start
+        with prefix, at most limit of them. A corrupt index has none.
+        """
+        try:
+            records = self.snapshot.lookup(key + (prefix or ""), self.limit)
+        except ValueError:
+            return []
+        return [record[len(key):] for record in records]
+
+    def pid(self):
+        """
+        Return the PID of the watcher that wrote the index
+        """
+        return int(self.values(self.key("pid"))[0])
+
+    def matches(self, ike, ike_id):
+        """
+        Return False if the IKE_SA with the given ID does not have the given name
+        """
+        return not ike or not ike_id or ike in self.values(self.key("ike-names", ike_id))
+
+    def ike_names(self, ike_id=None, prefix=""):
+        """
+        Return the names of all IKE_SAs, or of the one with the given ID,
+        that start with prefix
+        """
+        return self.values(self.key("ike-names", ike_id or ""), prefix)
+
+    def ike_ids(self, ike=None, prefix=""):
+        """
+        Return the unique IDs of all IKE_SAs, optionally only of those with
+        the given name, that start with prefix
+        """
+        return self.values(self.key("ike-ids", ike or ""), prefix)
+
+    def child_names(self, ike=None, ike_id=None, prefix=""):
+        """
+        Return the names of all CHILD_SAs, optionally only those of the IKE_SAs
+        with the given name or unique ID, that start with prefix
+        """
+        if not self.matches(ike, ike_id):
+            return []
+        key = self.key("child-names", "" if ike_id else ike or "", ike_id or "")
+        return self.values(key, prefix)
+
+    def child_ids(self, ike=None, ike_id=None, child=None, prefix=""):
+        """
+        Return the unique IDs of all CHILD_SAs, optionally only those with
+        the given name or of the IKE_SAs with the given name or unique ID,
+        that start with prefix
+        """
+        if not self.matches(ike, ike_id):
+            return []
+        key = self.key("child-ids", "" if ike_id else ike or "", ike_id or "", child or "")
+        return self.values(key, prefix)
 
 if __name__ == "__main__":
     SwanctlAutoComplete.main()
-' --words="${words[*]}" --cur="${cur}" --prev="${prev}" --cword="$cword" )
-ret=$?
-
-case $ret in
-    4)
-    _filedir
-    return
-    ;;
-    5)
-    _known_hosts_real -- "$cur"
-    return
-    ;;
-esac
-
-COMPREPLY=( $(compgen -W "${REPLY}" -- "$cur") )
+' "$@"
+    fi
+}
+
+_swanctl() {
+    local cur prev words cword key header magic version action flags candidate
+    # keep = and : in the words, e.g. in subjects (C=CH,O=strongSwan) and
+    # URIs, instead of splitting them at COMP_WORDBREAKS
+    _init_completion -n =: || return
+
+    # everything but the current word
+    key="$cword ${words[*]:0:cword} | ${words[*]:cword+1}"
+    if [[ $key == "$_swanctl_memo_key" && $cur == "$_swanctl_memo_cur"* ]] &&
+        (( SECONDS - _swanctl_memo_time < ${SWANCTL_COMPLETION_MEMO_TTL:-5} )); then
+        COMPREPLY=()
+        for candidate in "${_swanctl_memo_reply[@]}"; do
+            [[ $candidate == "$cur"* ]] && COMPREPLY+=("$candidate")
+        done
+        if [[ -n $_swanctl_memo_quote ]]; then
+            compopt -o filenames 2>/dev/null
+        fi
+        _swanctl_ltrim_wordbreaks
+        return
+    fi
+    _swanctl_memo_key=
+
+    COMPREPLY=()
+    {
+        IFS= read -r header
+        mapfile -d '' -t COMPREPLY
+    } < <(_swanctl_server "${words[*]}" "$cur" "$prev" "$cword" 1 ||
+          _swanctl_run --words="${words[*]}" --cur="$cur" --prev="$prev" \
+                       --cword="$cword" --started="$EPOCHREALTIME" --protocol=1)
+    read -r magic version action flags <<< "$header"
+    if [[ $magic != swanctl-completion ]]; then
+        # a server started before the protocol was introduced, it answers
+        # with an exit status and the candidates separated by spaces
+        COMPREPLY=( $(compgen -W "${COMPREPLY[*]}" -- "$cur") )
+        return
+    fi
+    [[ $version == 1 ]] || return
+
+    case $action in
+        filedir)
+        _filedir
+        return
+        ;;
+        hosts)
+        _known_hosts_real -- "$cur"
+        return
+        ;;
+    esac
+
+    if [[ ,$flags, != *,filtered,* ]]; then
+        local candidates=("${COMPREPLY[@]}")
+        COMPREPLY=()
+        for candidate in "${candidates[@]}"; do
+            [[ $candidate == "$cur"* ]] && COMPREPLY+=("$candidate")
+        done
+    fi
+    if [[ ,$flags, == *,reusable,* ]]; then
+        _swanctl_memo_key=$key
+        _swanctl_memo_cur=$cur
+        _swanctl_memo_time=$SECONDS
+        _swanctl_memo_reply=("${COMPREPLY[@]}")
+        _swanctl_memo_quote=
+    fi
+    if [[ ,$flags, == *,quote,* ]]; then
+        # let readline quote spaces and other special characters, e.g. in
+        # subjects or identities, when inserting a candidate
+        compopt -o filenames 2>/dev/null
+        _swanctl_memo_quote=1
+    fi
+    _swanctl_ltrim_wordbreaks
+    if [[ ,$flags, == *,truncated,* ]]; then
+        # there are more candidates than shown. The extra entry tells the user and
+        # keeps bash from inserting the common prefix of the shown ones only.
+        COMPREPLY+=("(more...)")
+    fi
 } &&
-complete -o nosort -F _swanctl swanctl
\ No newline at end of file
+complete -o nosort -F _swanctl swanctl
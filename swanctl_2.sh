@@ -1,23 +1,134 @@
 # swanctl completion
 
+# Directory of the precompiled swanctl_completion module, set by
+# "makeme.sh install". The embedded script below is used if it is empty or the
+# module is missing.
+_swanctl_module_dir=
+
+# Ask the optional completion server (swanctl.py --server) for suggestions.
+# Prints its answer, see _swanctl_run. Fails if no server is listening, it
+# did not answer or socat is not available. Sockets of other users, or in
+# a directory of another user, are not trusted.
+_swanctl_server() {
+    local sock=${SWANCTL_COMPLETION_SOCKET} header
+    if [[ -z $sock ]]; then
+        if [[ -n $XDG_RUNTIME_DIR ]]; then
+            sock=$XDG_RUNTIME_DIR/swanctl-completion.sock
+        else
+            sock=/tmp/swanctl-completion-$UID/server.sock
+        fi
+    fi
+    [[ -S $sock && -O $sock && -O ${sock%/*} ]] && type -P socat &>/dev/null || return 1
+    printf '%s\n' "$@" | socat -t 1 - UNIX-CONNECT:"$sock" 2>/dev/null | {
+        IFS= read -r header && printf '%s\n' "$header" && cat
+    }
+}
+
+# Candidates of the last completion, which are reused while only the current
+# word grows (see the reusable flag below)
+_swanctl_memo_key=
+_swanctl_memo_cur=
+_swanctl_memo_time=
+_swanctl_memo_reply=()
+_swanctl_memo_quote=
+
+# Readline only replaces the part of the current word after the last = or :
+# in COMP_WORDBREAKS, strip what is in front of it from the candidates, like
+# __ltrim_colon_completions does for colons only
+_swanctl_ltrim_wordbreaks() {
+    local breaks=${COMP_WORDBREAKS//[^=:]/}
+    [[ -n $breaks && $cur == *[$breaks]* ]] || return
+    local prefix=${cur%"${cur##*[$breaks]}"}
+    COMPREPLY=("${COMPREPLY[@]#"$prefix"}")
+}
+
+# Run swanctl.py with the given arguments. With --protocol=1 it prints a
+# header line "swanctl-completion 1 ACTION FLAGS" followed by the candidates,
+# each terminated by a NUL character.
+_swanctl_run() {
+    if [[ -n $_swanctl_module_dir && -r $_swanctl_module_dir/swanctl_completion.py ]]; then
+        # -I -S skip site and the environment, the module is loaded from
+        # its cached bytecode
+        python3 -I -S -c "import sys; sys.path.insert(0, sys.argv.pop(1)); import swanctl_completion; swanctl_completion.SwanctlAutoComplete.main()" "$_swanctl_module_dir" "$@"
+    else
+        python ./swanctl.py "$@"
+    fi
+}
+
 _swanctl() {
-    local cur prev words cword
-    _init_completion || return
-
-    REPLY=$(python ./swanctl.py --words="${words[*]}" --cur="${cur}" --prev="${prev}" --cword="$cword" )
-ret=$?
-
-case $ret in
-    4)
-    _filedir
-    return
-    ;;
-    5)
-    _known_hosts_real -- "$cur"
-    return
-    ;;
-esac
-
-COMPREPLY=( $(compgen -W "${REPLY}" -- "$cur") )
+    local cur prev words cword key header magic version action flags candidate
+    # keep = and : in the words, e.g. in subjects (C=CH,O=strongSwan) and
+    # URIs, instead of splitting them at COMP_WORDBREAKS
+    _init_completion -n =: || return
+
+    # everything but the current word
+    key="$cword ${words[*]:0:cword} | ${words[*]:cword+1}"
+    if [[ $key == "$_swanctl_memo_key" && $cur == "$_swanctl_memo_cur"* ]] &&
+        (( SECONDS - _swanctl_memo_time < ${SWANCTL_COMPLETION_MEMO_TTL:-5} )); then
+        COMPREPLY=()
+        for candidate in "${_swanctl_memo_reply[@]}"; do
+            [[ $candidate == "$cur"* ]] && COMPREPLY+=("$candidate")
+        done
+        if [[ -n $_swanctl_memo_quote ]]; then
+            compopt -o filenames 2>/dev/null
+        fi
+        _swanctl_ltrim_wordbreaks
+        return
+    fi
+    _swanctl_memo_key=
+
+    COMPREPLY=()
+    {
+        IFS= read -r header
+        mapfile -d '' -t COMPREPLY
+    } < <(_swanctl_server "${words[*]}" "$cur" "$prev" "$cword" 1 ||
+          _swanctl_run --words="${words[*]}" --cur="$cur" --prev="$prev" \
+                       --cword="$cword" --started="$EPOCHREALTIME" --protocol=1)
+    read -r magic version action flags <<< "$header"
+    if [[ $magic != swanctl-completion ]]; then
+        # a server started before the protocol was introduced, it answers
+        # with an exit status and the candidates separated by spaces
+        COMPREPLY=( $(compgen -W "${COMPREPLY[*]}" -- "$cur") )
+        return
+    fi
+    [[ $version == 1 ]] || return
+
+    case $action in
+        filedir)
+        _filedir
+        return
+        ;;
+        hosts)
+        _known_hosts_real -- "$cur"
+        return
+        ;;
+    esac
+
+    if [[ ,$flags, != *,filtered,* ]]; then
+        local candidates=("${COMPREPLY[@]}")
+        COMPREPLY=()
+        for candidate in "${candidates[@]}"; do
+            [[ $candidate == "$cur"* ]] && COMPREPLY+=("$candidate")
+        done
+    fi
+    if [[ ,$flags, == *,reusable,* ]]; then
+        _swanctl_memo_key=$key
+        _swanctl_memo_cur=$cur
+        _swanctl_memo_time=$SECONDS
+        _swanctl_memo_reply=("${COMPREPLY[@]}")
+        _swanctl_memo_quote=
+    fi
+    if [[ ,$flags, == *,quote,* ]]; then
+        # let readline quote spaces and other special characters, e.g. in
+        # subjects or identities, when inserting a candidate
+        compopt -o filenames 2>/dev/null
+        _swanctl_memo_quote=1
+    fi
+    _swanctl_ltrim_wordbreaks
+    if [[ ,$flags, == *,truncated,* ]]; then
+        # there are more candidates than shown. The extra entry tells the user and
+        # keeps bash from inserting the common prefix of the shown ones only.
+        COMPREPLY+=("(more...)")
+    fi
 } &&
-complete -o nosort -F _swanctl swanctl
\ No newline at end of file
+complete -o nosort -F _swanctl swanctl